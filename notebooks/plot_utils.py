@@ -3,12 +3,98 @@ import plotly.offline as py
 import plotly.graph_objs as go
 py.init_notebook_mode(connected=True)
 
+# Figures with more points than this are drawn with WebGL
+WEBGL_THRESHOLD = 10000
+
+def lttb(x, y, n_out):
+    """
+        Largest-Triangle-Three-Buckets downsampling.
+        Returns the indices of the n_out points that best preserve the shape of the curve.
+        @param x: x values, sorted
+        @param y: y values
+        @param n_out: number of points to keep
+    """
+    n_in = len(x)
+    if n_out >= n_in or n_out < 3:
+        return np.arange(n_in)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # The first and last points are always kept. The others are split into buckets.
+    edges = np.linspace(1, n_in - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n_in - 1
+
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i+1]
+        # Average of the next bucket, or the last point
+        if i < n_out - 3:
+            next_x = x[edges[i+1]:edges[i+2]].mean()
+            next_y = y[edges[i+1]:edges[i+2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        prev_x, prev_y = x[indices[i]], y[indices[i]]
+        areas = np.abs((prev_x - next_x) * (y[start:stop] - prev_y) - (prev_x - x[start:stop]) * (next_y - prev_y))
+        indices[i+1] = start + np.nanargmax(areas) if np.any(np.isfinite(areas)) else start
+    return indices
+
+def block_reduce(x, y, z, max_shape=(500, 500)):
+    """
+        Reduce a heatmap by averaging blocks of pixels so that it is no larger than max_shape.
+        @param x: x values, either one per column or the column edges
+        @param y: y values, either one per row or the row edges
+        @param z: 2D array of shape [len(y), len(x)]
+        @param max_shape: maximum (rows, columns) of the output
+    """
+    z = np.asarray(z, dtype=float)
+    n_y, n_x = z.shape
+    f_y = int(np.ceil(n_y / float(max_shape[0])))
+    f_x = int(np.ceil(n_x / float(max_shape[1])))
+    if f_y <= 1 and f_x <= 1:
+        return x, y, z
+
+    def _reduce_axis(values, n, factor):
+        values = np.asarray(values, dtype=float)
+        if len(values) == n + 1:
+            # Bin edges
+            return np.append(values[:-1:factor], values[-1])
+        padded = np.full(int(np.ceil(n / float(factor))) * factor, np.nan)
+        padded[:n] = values
+        return np.nanmean(padded.reshape(-1, factor), axis=1)
+
+    padded = np.full((int(np.ceil(n_y / float(f_y))) * f_y, int(np.ceil(n_x / float(f_x))) * f_x), np.nan)
+    padded[:n_y, :n_x] = z
+    n_rows, n_cols = padded.shape[0] // f_y, padded.shape[1] // f_x
+    # Every block has at least one pixel that is not padding
+    blocks = padded.reshape(n_rows, f_y, n_cols, f_x).transpose(0, 2, 1, 3).reshape(n_rows, n_cols, f_y * f_x)
+    reduced = np.nanmean(blocks, axis=2)
+    return _reduce_axis(x, n_x, f_x), _reduce_axis(y, n_y, f_y), reduced
+
+def decimate(traces, max_points):
+    """
+        Downsample a list of traces [x, y, dy, dx] so that the figure has at most max_points.
+        Each trace keeps a share of the budget proportional to its length.
+    """
+    n_total = sum([len(trace[0]) for trace in traces])
+    if max_points is None or n_total <= max_points:
+        return traces
+    output = []
+    for trace in traces:
+        n_out = max(3, int(max_points * len(trace[0]) / float(n_total)))
+        idx = lttb(trace[0], trace[1], n_out)
+        output.append([np.asarray(item)[idx] for item in trace])
+    return output
+
 def plot1d(data_list, data_names=None, x_title='', y_title='',
-           x_log=False, y_log=False, show_dx=True, width=800, height=400):
+           x_log=False, y_log=False, show_dx=True, width=800, height=400,
+           max_points=50000):
     """
         Produce a 1D plot
         @param data_list: list of traces [ [x1, y1], [x2, y2], ...]
         @param data_names: name for each trace, for the legend
+        @param max_points: figures with more points are downsampled with LTTB [None to keep all points].
+                           Figures with more than WEBGL_THRESHOLD points are drawn with WebGL.
     """
     from plotly.offline import plot
     import plotly.graph_objs as go
@@ -25,23 +111,28 @@ def plot1d(data_list, data_names=None, x_title='', y_title='',
         if isinstance(data_names, list) and len(data_names) == 1:
             label = data_names[0]
             show_legend = True
-        data = [go.Scatter(name=label, x=data_list[0], y=data_list[1])]
+        x, y = decimate([data_list], max_points)[0]
+        scatter = go.Scattergl if len(x) > WEBGL_THRESHOLD else go.Scatter
+        data = [scatter(name=label, x=x, y=y)]
     else:
-        for i in range(len(data_list)):
+        traces = decimate(data_list, max_points)
+        n_points = sum([len(trace[0]) for trace in traces])
+        scatter = go.Scattergl if n_points > WEBGL_THRESHOLD else go.Scatter
+        for i, trace in enumerate(traces):
             label = ''
             if isinstance(data_names, list) and len(data_names) == len(data_list):
                 label = data_names[i]
                 show_legend = True
             err_x = {}
             err_y = {}
-            if len(data_list[i]) >= 3:
-                err_y = dict(type='data', array=data_list[i][2], visible=True)
-            if len(data_list[i]) >= 4:
-                err_x = dict(type='data', array=data_list[i][3], visible=True)
+            if len(trace) >= 3:
+                err_y = dict(type='data', array=trace[2], visible=True)
+            if len(trace) >= 4:
+                err_x = dict(type='data', array=trace[3], visible=True)
                 if show_dx is False:
                     err_x['thickness'] = 0
-            data.append(go.Scatter(name=label, x=data_list[i][0], y=data_list[i][1],
-                                   error_x=err_x, error_y=err_y))
+            data.append(scatter(name=label, x=trace[0], y=trace[1],
+                                error_x=err_x, error_y=err_y))
 
 
     x_layout = dict(title=x_title, zeroline=False, exponentformat="power",
@@ -71,13 +162,16 @@ def plot1d(data_list, data_names=None, x_title='', y_title='',
     py.iplot(fig, show_link=False)
         
 def plot_heatmap(x, y, z, x_title='', y_title='', surface=False,
-                 x_log=False, y_log=False):
+                 x_log=False, y_log=False, max_shape=(500, 500)):
     """
         Produce a 2D plot
+        @param max_shape: larger z arrays are reduced by averaging blocks of pixels [None to keep all pixels]
     """
     from plotly.offline import plot
     import plotly.graph_objs as go
 
+    if max_shape is not None:
+        x, y, z = block_reduce(x, y, z, max_shape=max_shape)
 
     x_layout = dict(title=x_title, zeroline=False, exponentformat="power",
                     showexponent="all", showgrid=True,
@@ -115,6 +209,58 @@ def plot_heatmap(x, y, z, x_title='', y_title='', surface=False,
     
     
 
+def plot_band(accumulators, data_names=None, x_title='z', y_title='SLD',
+              magnetism=False, width=800, height=400):
+    """
+        Plot the mean and a one-sigma band for each Accumulator, without
+        plotting the individual draws.
+        @param accumulators: list of Accumulator objects
+        @param data_names: name for each accumulator, for the legend
+        @param magnetism: if True, plot the magnetic SLD instead
+    """
+    colors = ['31,119,180', '255,127,14', '44,160,44', '214,39,40', '148,103,189', '140,86,75']
+    data = []
+    for i, acc in enumerate(accumulators):
+        stats = acc.mean_magnetism() if magnetism else acc.mean()
+        if len(stats) == 3:
+            # The Accumulator of the error_analysis notebook also returns z
+            z, avg, sig = stats
+        else:
+            avg, sig = stats
+            z = (acc.z[1:] + acc.z[:-1]) / 2.0
+        z, avg, sig = np.asarray(z), np.asarray(avg), np.asarray(sig)
+
+        label = data_names[i] if data_names is not None else acc.name
+        color = colors[i % len(colors)]
+        data.append(go.Scatter(x=z, y=avg + sig, mode='lines', line=dict(width=0),
+                               showlegend=False, hoverinfo='skip'))
+        data.append(go.Scatter(x=z, y=avg - sig, mode='lines', line=dict(width=0),
+                               fill='tonexty', fillcolor='rgba(%s,0.3)' % color,
+                               showlegend=False, hoverinfo='skip'))
+        data.append(go.Scatter(x=z, y=avg, mode='lines', name=label,
+                               line=dict(color='rgb(%s)' % color)))
+
+    x_layout = dict(title=x_title, zeroline=False, exponentformat="power",
+                    showexponent="all", showgrid=True,
+                    showline=True, mirror="all", ticks="inside")
+    y_layout = dict(title=y_title, zeroline=False, exponentformat="power",
+                    showexponent="all", showgrid=True,
+                    showline=True, mirror="all", ticks="inside")
+
+    layout = go.Layout(
+        showlegend=True,
+        autosize=True,
+        width=width,
+        height=height,
+        margin=dict(t=40, b=40, l=80, r=40),
+        hovermode='closest',
+        xaxis=x_layout,
+        yaxis=y_layout
+    )
+
+    fig = go.Figure(data=data, layout=layout)
+    py.iplot(fig, show_link=False)
+
 def fill_dict(accum_dict, value):
     if value[0] in ['#', 'File']:
         accum_dict[value[0]] = value[1]
@@ -0,0 +1,261 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-locals, too-many-arguments
+"""
+    Batched optical matrix (Abeles) reflectivity calculation.
+
+    This evaluates many layer stacks against a shared kz vector in one call,
+    following the conventions of refl1d.abeles.refl:
+
+        - Slabs are ordered with the surface (incident medium) at index 0 and
+          the substrate at index -1, or reversed if kz < 0.
+        - The thickness of the incident medium and substrate are ignored.
+        - sigma[i] is the roughness between layer i and layer i+1, applied
+          with the Nevot-Croce factor.
+        - SLDs are in units of 1e-6/A^2.
+
+    Below the critical edge, kz^2 - 4 pi rho is negative and the square root
+    sits on its branch cut. numpy and C choose opposite signs for sqrt(-A + 0i),
+    which is what the abeles and refnx_vs_refl1d notebooks show. As in refl1d,
+    a tiny absorption is always added so that the physical branch is used
+    whether or not the stack has absorption.
+
+    The matrix product is evaluated with the equivalent Parratt recursion,
+    updating the reflection amplitude in place, and stacks are processed in
+    groups of about CHUNK_BYTES so the work arrays stay in cache.
+
+    Validation against refl1d and throughput:
+
+        python batch_abeles.py -n 1000
+"""
+from __future__ import absolute_import, division, print_function
+import time
+import argparse
+import numpy as np
+
+# Tiny absorption used to force the branch cut of the square root
+BRANCH_CUT_EPSILON = 1e-30
+
+# Size of the work arrays for a group of stacks. Groups of stacks that fit
+# in cache are much faster than one pass over all of them.
+CHUNK_BYTES = 2**20
+
+
+def _as_stacks(values, n_stacks, n_layers, name):
+    """ Broadcast a parameter to a [n_stacks, n_layers] array """
+    values = np.asarray(values, dtype=float)
+    if values.ndim > 2:
+        raise ValueError("%s should have at most two dimensions" % name)
+    try:
+        return np.broadcast_to(values, (n_stacks, n_layers))
+    except ValueError:
+        raise ValueError("%s has shape %s, expected (%s, %s)" % (name, values.shape, n_stacks, n_layers))
+
+
+def _calc(kz, depth, rho, irho, sigma):
+    """
+        Reflectivity amplitude for positive kz.
+        All stack parameters are [n_stacks, n_layers] arrays and kz is [n_q].
+
+        The product of the Abeles matrices is computed with the equivalent
+        Parratt recursion, from the substrate up, updating arrays in place.
+    """
+    n_layers = depth.shape[1]
+
+    # Wave vector in each layer, relative to the incident medium: [n_stacks, n_layers, n_q]
+    k = kz[None, None, :]**2 + 4e-6 * np.pi * (rho[:, 0:1, None] - rho[:, :, None] - 1j * irho[:, :, None])
+    np.sqrt(k, out=k)
+    k[:, 0] = kz[None, :]
+
+    # Fresnel coefficient of each interface, with the Nevot-Croce factor
+    k_top = k[:, :-1]
+    k_bottom = k[:, 1:]
+    F = k_top - k_bottom
+    F /= k_top + k_bottom
+    if np.any(sigma != 0):
+        roughness = k_top * k_bottom
+        roughness *= -2 * sigma[:, :, None]**2
+        np.exp(roughness, out=roughness)
+        F *= roughness
+
+    r = F[:, -1].copy()
+    work = np.empty_like(r)
+    for i in range(n_layers - 3, -1, -1):
+        # Phase across layer i+1
+        np.multiply(k[:, i+1], -2j * depth[:, i+1:i+2], out=work)
+        np.exp(work, out=work)
+        r *= work
+        # r = (F + r) / (1 + F r)
+        np.multiply(F[:, i], r, out=work)
+        work += 1
+        r += F[:, i]
+        r /= work
+    return r
+
+
+def _calc_chunks(kz, depth, rho, irho, sigma, out):
+    """ Compute _calc() over groups of stacks small enough to keep the work arrays in cache """
+    step = max(1, CHUNK_BYTES // (16 * depth.shape[1] * max(len(kz), 1)))
+    for start in range(0, depth.shape[0], step):
+        chunk = slice(start, start + step)
+        out[chunk] = _calc(kz, depth[chunk], rho[chunk], irho[chunk], sigma[chunk])
+
+
+def refl(kz, depth, rho, irho=0, sigma=0):
+    """
+        Reflectivity amplitude for a set of layer stacks.
+
+        @param kz: kz values, shared by all stacks [1/A]. This is Q/2.
+        @param depth: [n_stacks, n_layers] layer thicknesses [A]
+        @param rho: [n_stacks, n_layers] SLD [1e-6/A^2]
+        @param irho: [n_stacks, n_layers] absorption [1e-6/A^2]
+        @param sigma: [n_stacks, n_layers-1] interface roughness [A]
+
+        Parameters given for a single stack, or as scalars, are broadcast
+        to all stacks. If depth is one-dimensional, the output is [n_q],
+        otherwise it is [n_stacks, n_q].
+    """
+    kz = np.atleast_1d(np.asarray(kz, dtype=float))
+    single_stack = np.ndim(depth) == 1
+    depth = np.atleast_2d(np.asarray(depth, dtype=float))
+    n_stacks, n_layers = depth.shape
+
+    rho = _as_stacks(rho, n_stacks, n_layers, 'rho')
+    irho = np.abs(_as_stacks(irho, n_stacks, n_layers, 'irho')) + BRANCH_CUT_EPSILON
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim > 0 and sigma.shape[-1] == n_layers:
+        sigma = sigma[..., :-1]
+    sigma = _as_stacks(sigma, n_stacks, n_layers - 1, 'sigma')
+
+    r = np.empty((n_stacks, len(kz)), dtype=complex)
+    positive = kz >= 1e-10
+    negative = kz <= -1e-10
+    if np.all(positive):
+        _calc_chunks(kz, depth, rho, irho, sigma, r)
+    else:
+        if np.any(positive):
+            r_positive = np.empty((n_stacks, np.sum(positive)), dtype=complex)
+            _calc_chunks(kz[positive], depth, rho, irho, sigma, r_positive)
+            r[:, positive] = r_positive
+        if np.any(negative):
+            r_negative = np.empty((n_stacks, np.sum(negative)), dtype=complex)
+            _calc_chunks(-kz[negative], depth[:, ::-1], rho[:, ::-1], irho[:, ::-1], sigma[:, ::-1], r_negative)
+            r[:, negative] = r_negative
+    r[:, ~(positive | negative)] = -1
+
+    if single_stack:
+        return r[0]
+    return r
+
+
+def reflectivity(kz, depth, rho, irho=0, sigma=0):
+    """ Reflectivity |r|^2 for a set of layer stacks. See refl() """
+    r = refl(kz, depth, rho, irho=irho, sigma=sigma)
+    return r.real**2 + r.imag**2
+
+
+def _reference_reflectivity():
+    """ Return the refl1d reflectivity function """
+    try:
+        from refl1d.reflectivity import reflectivity as refl1d_reflectivity
+    except ImportError:
+        # Newer versions of refl1d
+        from refl1d.sample.reflectivity import reflectivity as refl1d_reflectivity
+    return refl1d_reflectivity
+
+
+def notebook_stacks():
+    """
+        Stacks used in the abeles and refnx_vs_refl1d notebooks.
+        Returns a list of (description, depth, rho, irho, sigma).
+    """
+    epsilon = 0.000136 # Representative of actual D2O absorption
+    return [
+        ("increasing SLD, Im=epsilon", [0, 850, 0], [2.067, 4.3, 6.], [0.0, 0.1, epsilon], [35, 5.]),
+        ("increasing SLD, Im=0", [0, 850, 0], [2.067, 4.3, 6.], [0.0, 0.1, 0.], [35, 5.]),
+        ("thick absorbing film", [0, 1200, 0], [2.07, 4.66, 6.36], [0, 0.016, 0], [10, 3]),
+        ("gold electrode", [0, 4.94, 60, 850, 10, 0], [2.067, 3.025, 2.8, 4.264, 4, 6.05],
+         [0, 0., 0, 0.1, 0, 0], [2.0, 1.6, 35, 1.017, 4.963]),
+    ]
+
+
+def random_stacks(n_stacks, n_layers, seed=None):
+    """ Random stacks, with some of them having a backing medium of higher SLD """
+    rng = np.random.RandomState(seed)
+    depth = rng.uniform(5, 500, size=(n_stacks, n_layers))
+    depth[:, 0] = depth[:, -1] = 0
+    rho = rng.uniform(-2, 7, size=(n_stacks, n_layers))
+    irho = rng.uniform(0, 0.1, size=(n_stacks, n_layers)) * (rng.uniform(size=(n_stacks, n_layers)) > 0.5)
+    sigma = rng.uniform(0, 30, size=(n_stacks, n_layers - 1))
+    return depth, rho, irho, sigma
+
+
+def validate(kz, depth, rho, irho, sigma, tolerance=1e-8):
+    """
+        Compare the batched calculation to refl1d, one stack at a time.
+        Returns the largest relative error and whether it is within tolerance.
+    """
+    refl1d_reflectivity = _reference_reflectivity()
+    r_batch = reflectivity(kz, depth, rho, irho=irho, sigma=sigma)
+    max_error = 0
+    for i in range(len(depth)):
+        r_ref = refl1d_reflectivity(kz, depth[i], rho[i], irho=irho[i], sigma=sigma[i])
+        error = np.max(np.abs(r_batch[i] - r_ref) / np.maximum(np.abs(r_ref), 1e-300))
+        max_error = max(max_error, error)
+    return max_error, max_error < tolerance
+
+
+def benchmark(kz, depth, rho, irho, sigma, repeat=3):
+    """
+        Time the batched calculation and the refl1d calculation.
+        Returns the throughput of each, in stacks*Q-points per second.
+    """
+    n_points = len(depth) * len(kz)
+
+    t_batch = np.inf
+    for _ in range(repeat):
+        t0 = time.time()
+        reflectivity(kz, depth, rho, irho=irho, sigma=sigma)
+        t_batch = min(t_batch, time.time() - t0)
+
+    refl1d_reflectivity = _reference_reflectivity()
+    t_ref = np.inf
+    for _ in range(repeat):
+        t0 = time.time()
+        for i in range(len(depth)):
+            refl1d_reflectivity(kz, depth[i], rho[i], irho=irho[i], sigma=sigma[i])
+        t_ref = min(t_ref, time.time() - t0)
+
+    return n_points / t_batch, n_points / t_ref
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Validate and benchmark the batched Abeles calculation')
+    parser.add_argument('-n', metavar='n_stacks', type=int, help='number of random stacks',
+                        dest='n_stacks', default=1000)
+    parser.add_argument('-l', metavar='n_layers', type=int, help='number of layers per stack, including media',
+                        dest='n_layers', default=8)
+    parser.add_argument('-q', metavar='n_q', type=int, help='number of Q points',
+                        dest='n_q', default=500)
+    parser.add_argument('-t', metavar='tolerance', type=float, help='relative tolerance',
+                        dest='tolerance', default=1e-8)
+    namespace = parser.parse_args()
+
+    q = np.linspace(0.008, 0.2, namespace.n_q)
+
+    all_ok = True
+    for description, _depth, _rho, _irho, _sigma in notebook_stacks():
+        _error, _ok = validate(q / 2.0, np.asarray([_depth]), np.asarray([_rho]),
+                               np.asarray([_irho]), np.asarray([_sigma]), namespace.tolerance)
+        all_ok = all_ok and _ok
+        print("%30s: max relative error = %g  [%s]" % (description, _error, 'OK' if _ok else 'FAILED'))
+
+    stacks = random_stacks(namespace.n_stacks, namespace.n_layers, seed=42)
+    _error, _ok = validate(q / 2.0, *stacks, tolerance=namespace.tolerance)
+    all_ok = all_ok and _ok
+    print("%30s: max relative error = %g  [%s]" % ('%s random stacks' % namespace.n_stacks, _error, 'OK' if _ok else 'FAILED'))
+
+    batch_rate, ref_rate = benchmark(q / 2.0, *stacks)
+    print("Batched: %.3g stacks*Q-points/sec" % batch_rate)
+    print("refl1d:  %.3g stacks*Q-points/sec" % ref_rate)
+
+    if not all_ok:
+        raise SystemExit(1)
@@ -0,0 +1,250 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-locals, too-many-arguments, global-statement
+"""
+    Chi2 landscape and profile likelihood over one or two fit parameters.
+
+    A FitProblem is loaded from a refl1d model script (for instance one of the
+    data/*_model.py files) and chi2 is evaluated on a grid of values for one
+    or two of its parameters. The other parameters are either kept at their
+    starting values, or re-optimized at each grid point to give a profile
+    likelihood.
+
+    Grid points are spread over a process pool one grid line at a time. Each
+    worker loads the model once and walks its line in order, so consecutive
+    evaluations only differ by one parameter and each re-optimization starts
+    from the optimum found at the neighbouring point. Each line starts from the
+    model's values at its middle point and works outwards. Results are written
+    to a .npz file.
+
+        python chi2_landscape.py -m ../data/207296_model.py -p "SEI thickness" 100:300:21 -p "material thickness" 15:100:18 -o landscape.npz
+
+        python chi2_landscape.py -m ../data/207296_model.py -p "SEI rho" 3:4.3:27 --optimize -j 8 -o sei_rho.npz
+
+    Note that data/hydration_model-empty.py is a template and cannot be used
+    as is: it refers to a THF layer that its sample does not define.
+"""
+from __future__ import absolute_import, division, print_function
+import logging
+import multiprocessing
+import os
+import time
+import argparse
+import numpy as np
+
+# Problem loaded by each worker process
+_PROBLEM = None
+
+
+def load_problem(model_path):
+    """
+        Load a FitProblem from a model script.
+        Model scripts often load data files with relative paths, so the
+        script is executed from its own directory.
+    """
+    from bumps.cli import load_model
+
+    cwd = os.getcwd()
+    model_dir, model_file = os.path.split(os.path.abspath(model_path))
+    try:
+        os.chdir(model_dir)
+        return load_model(model_file)
+    finally:
+        os.chdir(cwd)
+
+
+def parse_grid(text):
+    """ Parse a grid definition of the form start:stop:n_points """
+    toks = text.split(':')
+    if len(toks) != 3:
+        raise ValueError("Grid should be given as start:stop:n_points, got %s" % text)
+    return np.linspace(float(toks[0]), float(toks[1]), int(toks[2]))
+
+
+def _init_worker(model_path):
+    global _PROBLEM
+    _PROBLEM = load_problem(model_path)
+
+
+def _chi2(problem, pars):
+    problem.setp(pars)
+    return problem.chisq()
+
+
+def _optimize(problem, pars, free, bounds, max_iterations):
+    """ Minimize the nllf over the free parameters, starting from pars """
+    from scipy.optimize import minimize
+
+    pars = np.array(pars, dtype=float)
+    def nllf(x):
+        pars[free] = x
+        problem.setp(pars)
+        value = problem.nllf()
+        return value if np.isfinite(value) else 1e300
+
+    result = minimize(nllf, pars[free], method='L-BFGS-B', bounds=bounds,
+                      options=dict(maxiter=max_iterations))
+    pars[free] = result.x
+    return pars
+
+
+def _evaluate_line(task):
+    """
+        Evaluate a line of grid points, in order.
+        @param task: (line index, start parameters, list of (grid index, {parameter index: value}), optimize, max iterations)
+        @return: line index, list of (grid index, chi2, parameters)
+    """
+    line_index, start, points, optimize, max_iterations = task
+    problem = _PROBLEM
+    n_pars = len(start)
+    lower, upper = problem.bounds()
+    pars = np.array(start, dtype=float)
+
+    output = []
+    for grid_index, values in points:
+        for i, v in values.items():
+            pars[i] = v
+        if optimize:
+            free = np.asarray([i for i in range(n_pars) if i not in values], dtype=int)
+            bounds = [(lower[i] if np.isfinite(lower[i]) else None,
+                       upper[i] if np.isfinite(upper[i]) else None) for i in free]
+            if len(free) > 0:
+                pars = _optimize(problem, pars, free, bounds, max_iterations)
+        output.append((grid_index, _chi2(problem, pars), pars.copy()))
+    return line_index, output
+
+
+class Landscape(object):
+    """ Chi2 values over a grid of one or two parameters """
+    def __init__(self, labels, names, axes, chi2, parameters, optimized):
+        self.labels = labels
+        self.names = names
+        self.axes = axes
+        self.chi2 = chi2
+        self.parameters = parameters
+        self.optimized = optimized
+
+    def best(self):
+        """ Grid values and parameters at the lowest chi2 """
+        index = np.unravel_index(np.nanargmin(self.chi2), self.chi2.shape)
+        return [axis[i] for axis, i in zip(self.axes, index)], self.parameters[index]
+
+    def save(self, output):
+        """ Write the landscape to a .npz file """
+        arrays = dict(labels=np.asarray(self.labels), names=np.asarray(self.names),
+                      chi2=self.chi2, parameters=self.parameters, optimized=np.asarray(self.optimized))
+        for i, axis in enumerate(self.axes):
+            arrays['axis_%d' % i] = axis
+        np.savez_compressed(output, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            names = [str(n) for n in data['names']]
+            return cls([str(l) for l in data['labels']], names,
+                       [data['axis_%d' % i] for i in range(len(names))],
+                       data['chi2'], data['parameters'], bool(data['optimized']))
+
+    def __repr__(self):
+        values, _ = self.best()
+        printout = "Chi2 landscape over %s (%s points%s)\n" % \
+            (', '.join(self.names), self.chi2.size, ', profiled' if self.optimized else '')
+        printout += "   Best chi2=%g at %s\n" % (np.nanmin(self.chi2),
+                                                  ', '.join(['%s=%g' % (n, v) for n, v in zip(self.names, values)]))
+        return printout
+
+
+def compute_landscape(model_path, grid, optimize=False, processes=None, max_iterations=200):
+    """
+        Compute chi2 over a grid of parameter values.
+
+        @param model_path: refl1d model script defining `problem`
+        @param grid: list of one or two (parameter name, array of values)
+        @param optimize: if True, re-optimize the other parameters at each point
+        @param processes: number of worker processes, or None for all the CPUs
+        @param max_iterations: maximum number of optimizer iterations per point
+        @return: Landscape
+    """
+    if len(grid) not in [1, 2]:
+        raise ValueError("The grid should have one or two parameters")
+
+    _init_worker(model_path)
+    problem = _PROBLEM
+    labels = list(problem.labels())
+    names = [g[0] for g in grid]
+    axes = [np.asarray(g[1], dtype=float) for g in grid]
+    for name in names:
+        if name not in labels:
+            raise ValueError("Unknown parameter %s: should be one of %s" % (name, labels))
+    indices = [labels.index(name) for name in names]
+
+    # Start from the model's values, moved inside the bounds if needed
+    start = np.asarray(problem.getp(), dtype=float)
+    lower, upper = problem.bounds()
+    clipped = np.clip(start, lower, upper)
+    for i in np.flatnonzero(clipped != start):
+        logging.warning("Starting value of %s is out of bounds: using %s", labels[i], clipped[i])
+    start = clipped
+
+    # One task per grid line along the last axis
+    shape = tuple(len(axis) for axis in axes)
+    outer = range(shape[0]) if len(shape) == 2 else [None]
+    tasks = []
+    for line_index, i in enumerate(outer):
+        points = []
+        for j in range(shape[-1]):
+            values = {indices[-1]: axes[-1][j]}
+            grid_index = (j,)
+            if i is not None:
+                values[indices[0]] = axes[0][i]
+                grid_index = (i, j)
+            points.append((grid_index, values))
+        # Start at the middle of the line and work outwards in both
+        # directions, so that each point starts from a neighbour
+        middle = len(points) // 2
+        tasks.append((line_index, start, points[middle:], optimize, max_iterations))
+        if middle > 0:
+            tasks.append((line_index, start, points[middle-1::-1], optimize, max_iterations))
+
+    chi2 = np.full(shape, np.nan)
+    parameters = np.full(shape + (len(start),), np.nan)
+
+    t0 = time.time()
+    if processes == 1:
+        results = map(_evaluate_line, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(model_path,))
+        results = pool.imap_unordered(_evaluate_line, tasks)
+
+    for _, output in results:
+        for grid_index, _chi2_value, pars in output:
+            chi2[grid_index] = _chi2_value
+            parameters[grid_index] = pars
+
+    if processes != 1:
+        pool.close()
+        pool.join()
+    logging.info("Computed %s points in %s sec", chi2.size, time.time() - t0)
+
+    return Landscape(labels, names, axes, chi2, parameters, optimize)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute a chi2 landscape over one or two parameters')
+    parser.add_argument('-m', metavar='model', help='refl1d model script', dest='model_path', required=True)
+    parser.add_argument('-p', metavar=('name', 'start:stop:n'), nargs=2, action='append',
+                        help='parameter name and grid values', dest='grid', required=True)
+    parser.add_argument('-o', metavar='output_name', help='name of the output .npz file',
+                        dest='output_name', default='landscape.npz')
+    parser.add_argument('-j', metavar='processes', type=int, help='number of processes',
+                        dest='processes', default=None)
+    parser.add_argument('--optimize', help='re-optimize the other parameters at each point',
+                        dest='optimize', action='store_true', default=False)
+    parser.add_argument('--max-iterations', type=int, help='optimizer iterations per point',
+                        dest='max_iterations', default=200)
+    namespace = parser.parse_args()
+
+    landscape = compute_landscape(namespace.model_path,
+                                  [(name, parse_grid(values)) for name, values in namespace.grid],
+                                  optimize=namespace.optimize, processes=namespace.processes,
+                                  max_iterations=namespace.max_iterations)
+    landscape.save(namespace.output_name)
+    print(landscape)
@@ -0,0 +1,281 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name
+"""
+    Index the results of many refl1d fits in a local SQLite database.
+
+    Fit directories are crawled for .err files, which are parsed with
+    ReflectivityProblem. The overall chi2 (the model chi2 for single-model
+    fits, or NULL if the log has none), the chi2 of each model and the
+    fit parameters with their uncertainties are stored so that questions like
+    "which fits put Cu thickness above 500 with chi2 < 2" can be answered
+    without re-reading the logs.
+
+    Indexing is incremental: a file is only parsed again if its modification
+    time or size changed since it was last indexed. Files that cannot be
+    parsed are recorded with their error, so that they are also skipped
+    until they change.
+
+        python fit_index.py -d fits.db index /SNS/REF_L/IPTS-*/shared/fits
+
+        python fit_index.py -d fits.db query --chi2-max 2 "Cu thickness>500"
+"""
+from __future__ import absolute_import, division, print_function
+import logging
+import os
+import re
+import sqlite3
+import argparse
+
+from refl1d_model import ReflectivityProblem
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    chi2 REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS models (
+    fit_id INTEGER NOT NULL REFERENCES fits(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    chi2 REAL
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    fit_id INTEGER NOT NULL REFERENCES fits(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    error REAL
+);
+CREATE INDEX IF NOT EXISTS models_fit ON models(fit_id);
+CREATE INDEX IF NOT EXISTS parameters_fit ON parameters(fit_id);
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters(name, value);
+CREATE INDEX IF NOT EXISTS fits_chi2 ON fits(chi2);
+"""
+
+OPERATORS = ['<=', '>=', '<', '>', '=']
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _chi2(value):
+    """
+        Convert a chi2 parsed by ReflectivityProblem. The parser returns the
+        matched string, or the integer 0 when the file has no chi2.
+    """
+    if isinstance(value, int) and value == 0:
+        return None
+    return _to_float(value)
+
+
+def _fit_chi2(problem):
+    """
+        Overall chi2 of a fit. Only simultaneous fits have an overall chi2
+        line, so single-model fits use the chi2 of their model.
+    """
+    chi2 = _chi2(problem.chi2)
+    if chi2 is None and len(problem.model_list) == 1:
+        chi2 = _chi2(list(problem.model_list.values())[0].chi2)
+    return chi2
+
+
+def _clean_name(name):
+    """ Parameter names sometimes contain repeated spaces """
+    return ' '.join(name.split())
+
+
+def parse_constraint(text):
+    """
+        Parse a constraint of the form "Cu thickness>500"
+        Returns a (name, operator, value) tuple.
+    """
+    result = re.search(r'^(.*?)\s*(%s)\s*([-+\d.eE]+)$' % '|'.join(OPERATORS), text.strip())
+    if result is None:
+        raise ValueError("Could not parse constraint: %s" % text)
+    return _clean_name(result.group(1)), result.group(2), float(result.group(3))
+
+
+class FitIndex(object):
+    """ SQLite index of refl1d fit results """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        # Indexes created before failures were recorded have no error column
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(fits)")]
+        if 'error' not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE fits ADD COLUMN error TEXT")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, top_dirs, prune=True):
+        """
+            Crawl the given directories and index new or modified .err files.
+
+            @param top_dirs: directory or list of directories to crawl
+            @param prune: if True, remove entries for files that no longer exist
+                          under the crawled directories
+            @return: number of files indexed, skipped and removed, and the list
+                     of files that could not be parsed
+        """
+        if not isinstance(top_dirs, (list, tuple)):
+            top_dirs = [top_dirs]
+
+        known = dict((row[0], (row[1], row[2], row[3])) for row in
+                     self.connection.execute("SELECT path, id, mtime, size FROM fits"))
+        found = set()
+        n_indexed = 0
+        n_skipped = 0
+        failed = []
+
+        with self.connection:
+            for top_dir in top_dirs:
+                for root, _, files in os.walk(top_dir):
+                    for f in files:
+                        if not f.endswith('.err'):
+                            continue
+                        path = os.path.abspath(os.path.join(root, f))
+                        found.add(path)
+                        stat = os.stat(path)
+                        if path in known and known[path][1] == stat.st_mtime and known[path][2] == stat.st_size:
+                            n_skipped += 1
+                            continue
+                        if path in known:
+                            self.connection.execute("DELETE FROM fits WHERE id=?", (known[path][0],))
+                        if self._add_fit(path, stat):
+                            n_indexed += 1
+                        else:
+                            failed.append(path)
+
+            n_removed = 0
+            if prune:
+                prefixes = tuple(os.path.join(os.path.abspath(d), '') for d in top_dirs)
+                for path in known:
+                    if path.startswith(prefixes) and path not in found:
+                        self.connection.execute("DELETE FROM fits WHERE id=?", (known[path][0],))
+                        n_removed += 1
+
+        return n_indexed, n_skipped, n_removed, failed
+
+    def _add_fit(self, path, stat):
+        """
+            Parse a single .err file and store its content.
+            Files that cannot be parsed are stored with their error and no chi2.
+        """
+        try:
+            problem = ReflectivityProblem(path[:-len('.err')])
+        except Exception as e: #pylint: disable=broad-except
+            logging.error("Could not parse %s", path, exc_info=True)
+            self.connection.execute("INSERT INTO fits (path, mtime, size, error) VALUES (?, ?, ?, ?)",
+                                    (path, stat.st_mtime, stat.st_size, "%s: %s" % (type(e).__name__, e)))
+            return False
+
+        cursor = self.connection.execute("INSERT INTO fits (path, mtime, size, chi2) VALUES (?, ?, ?, ?)",
+                                         (path, stat.st_mtime, stat.st_size, _fit_chi2(problem)))
+        fit_id = cursor.lastrowid
+        self.connection.executemany("INSERT INTO models (fit_id, name, chi2) VALUES (?, ?, ?)",
+                                    [(fit_id, name, _chi2(m.chi2)) for name, m in problem.model_list.items()])
+        self.connection.executemany("INSERT INTO parameters (fit_id, name, value, error) VALUES (?, ?, ?, ?)",
+                                    [(fit_id, _clean_name(p[0]), p[1], p[2]) for p in problem.fit_params])
+        return True
+
+    def query(self, constraints=None, chi2_max=None, chi2_min=None):
+        """
+            Find fits matching a set of constraints.
+
+            A constraint name matches a parameter either exactly or as its trailing
+            part, so that "MGN_1 rho" also matches "T300 MGN_1 rho" in simultaneous fits.
+
+            @param constraints: list of (name, operator, value) or strings like "Cu thickness>500"
+            @param chi2_max: maximum overall chi2
+            @param chi2_min: minimum overall chi2
+            @return: list of (path, chi2), sorted by chi2
+        """
+        sql = "SELECT f.path, f.chi2 FROM fits f WHERE f.error IS NULL"
+        args = []
+        if chi2_max is not None:
+            sql += " AND f.chi2 < ?"
+            args.append(chi2_max)
+        if chi2_min is not None:
+            sql += " AND f.chi2 > ?"
+            args.append(chi2_min)
+
+        for constraint in constraints or []:
+            if not isinstance(constraint, (list, tuple)):
+                constraint = parse_constraint(constraint)
+            name, operator, value = constraint
+            if operator not in OPERATORS:
+                raise ValueError("Unknown operator: %s" % operator)
+            # Compare the trailing part of the name with substr() rather than LIKE, which
+            # would treat _ as a wildcard and ignore case
+            name = _clean_name(name)
+            sql += " AND EXISTS (SELECT 1 FROM parameters p WHERE p.fit_id = f.id" \
+                   " AND (p.name = ? OR substr(p.name, -length(?) - 1) = ' ' || ?) AND p.value %s ?)" % operator
+            args.extend([name, name, name, value])
+
+        sql += " ORDER BY f.chi2"
+        return self.connection.execute(sql, args).fetchall()
+
+    def failures(self):
+        """ Return the (path, error) list of files that could not be parsed """
+        return self.connection.execute("SELECT path, error FROM fits WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+    def parameters(self, path):
+        """ Return the [name, value, error] list stored for a fit """
+        rows = self.connection.execute("SELECT p.name, p.value, p.error FROM parameters p"
+                                       " JOIN fits f ON p.fit_id = f.id WHERE f.path = ? ORDER BY p.rowid",
+                                       (os.path.abspath(path),))
+        return [list(row) for row in rows]
+
+    def __repr__(self):
+        n_fits = self.connection.execute("SELECT COUNT(*) FROM fits WHERE error IS NULL").fetchone()[0]
+        n_failed = self.connection.execute("SELECT COUNT(*) FROM fits WHERE error IS NOT NULL").fetchone()[0]
+        n_pars = self.connection.execute("SELECT COUNT(*) FROM parameters").fetchone()[0]
+        return "Fit index %s: %s fits, %s parameters, %s unreadable files" % (self.db_path, n_fits, n_pars, n_failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index and query refl1d fit results')
+    parser.add_argument('-d', metavar='database', help='location of the SQLite database',
+                        dest='db_path', default='fit_index.db')
+    subparsers = parser.add_subparsers(dest='command')
+
+    index_parser = subparsers.add_parser('index', help='crawl directories for .err files')
+    index_parser.add_argument('directories', nargs='+', help='fit directories to crawl')
+    index_parser.add_argument('--no-prune', help='keep entries for files that were deleted',
+                              dest='prune', action='store_false', default=True)
+
+    query_parser = subparsers.add_parser('query', help='find fits matching constraints')
+    query_parser.add_argument('constraints', nargs='*', help='constraints like "Cu thickness>500"')
+    query_parser.add_argument('--chi2-max', type=float, dest='chi2_max', default=None)
+    query_parser.add_argument('--chi2-min', type=float, dest='chi2_min', default=None)
+
+    namespace = parser.parse_args()
+
+    with FitIndex(namespace.db_path) as fit_index:
+        if namespace.command == 'index':
+            indexed, skipped, removed, failed = fit_index.update(namespace.directories, prune=namespace.prune)
+            print("Indexed: %s   Unchanged: %s   Removed: %s   Failed: %s" % (indexed, skipped, removed, len(failed)))
+            for _path in failed:
+                print("   Could not parse %s" % _path)
+            print(fit_index)
+        elif namespace.command == 'query':
+            for _path, _chi2 in fit_index.query(namespace.constraints, chi2_max=namespace.chi2_max,
+                                                chi2_min=namespace.chi2_min):
+                print("%10s  %s" % (_chi2, _path))
+        else:
+            parser.print_help()
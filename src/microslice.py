@@ -0,0 +1,291 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-locals, too-many-arguments, too-many-instance-attributes
+"""
+    Adaptive microslicing of smooth SLD profiles.
+
+    Rough interfaces are usually rendered as a step profile with a fixed slab
+    width (dz=2 in ReflectivityProblem.convert_to_model). For thick, very rough
+    layers this produces hundreds of slabs, most of which sit in flat regions.
+    Here the fine profile is cut into slabs that are thin where the SLD changes
+    quickly and wide where it is flat.
+
+    The slab boundaries are chosen so that the change in reflectivity amplitude
+    stays below a given tolerance for all Q above q_min. In the Born
+    approximation, replacing a profile rho(z) by rho(z) + d_rho(z) changes the
+    reflectivity amplitude by
+
+        |dr(Q)| = 4 pi 1e-6 / Q * |integral d_rho(z) exp(iQz) dz|
+
+    with rho in units of 1e-6/A^2. Each slab takes the mean SLD of the fine
+    profile it replaces, so d_rho integrates to zero over the slab and its
+    contribution is bounded by
+
+        4 pi 1e-6 * min(integral |d_rho| dz / q_min, integral |d_rho| |z - z_c| dz)
+
+    where z_c is the center of the slab. The total bound is distributed evenly
+    along z, and a slab is accepted when its share is not exceeded. The bound
+    is with respect to the fine profile sampled at dz_min.
+
+    The slabs are meant to replace the fine profile in reflectivity
+    calculations: slice_experiment() cuts the profile rendered by a refl1d
+    Experiment, and SliceResult.stack() gives the layer stack for
+    batch_abeles.refl(). The fine profile still has to be rendered first, so
+    nothing is saved when only the profile itself is needed. For instance,
+    refl1d_model.py rebins each profile onto a coarse grid, and it uses the
+    rendered profile directly.
+
+        python microslice.py -t 1e-3 --sigma 105.5
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import numpy as np
+
+BORN_FACTOR = 4e-6 * np.pi
+
+
+def slab_profile(depth, rho, irho, sigma, dz=0.5, padding=None):
+    """
+        Smooth SLD profile of a slab model, with error function interfaces.
+        Slabs are ordered with the surface at index 0, as in batch_abeles.
+
+        @param depth: layer thicknesses [A]; those of the two media are ignored
+        @param rho: SLD of each layer [1e-6/A^2]
+        @param irho: absorption of each layer [1e-6/A^2]
+        @param sigma: roughness of each of the n_layers-1 interfaces [A]
+        @param dz: sampling step [A]
+        @param padding: distance to extend past the outer interfaces, 4*sigma by default
+        @return: z, rho, irho sampled at the middle of each step
+    """
+    from scipy.special import erf
+
+    depth = np.asarray(depth, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    irho = np.asarray(irho, dtype=float) * np.ones_like(rho)
+    sigma = np.asarray(sigma, dtype=float) * np.ones(len(depth) - 1)
+    sigma = sigma[:len(depth) - 1]
+
+    interfaces = np.concatenate([[0], np.cumsum(depth[1:-1])])
+    if padding is None:
+        padding = 4 * max(np.max(sigma), dz)
+    z = np.arange(-padding, interfaces[-1] + padding, dz) + dz / 2.0
+
+    rho_z = np.full(len(z), rho[0])
+    irho_z = np.full(len(z), irho[0])
+    for i, z_i in enumerate(interfaces):
+        if sigma[i] > 0:
+            step = 0.5 * (1 + erf((z - z_i) / (np.sqrt(2) * sigma[i])))
+        else:
+            step = 1.0 * (z >= z_i)
+        rho_z += (rho[i+1] - rho[i]) * step
+        irho_z += (irho[i+1] - irho[i]) * step
+    return z, rho_z, irho_z
+
+
+class SliceResult(object):
+    """
+        Slabs produced by adaptive_slices().
+        Slabs are in the order of the profile they were cut from, starting at z_start.
+    """
+    def __init__(self, depth, rho, irho, n_fine, n_fixed, error_bound, tolerance, q_min,
+                 z_start=0, rhoM=None):
+        self.depth = depth
+        self.rho = rho
+        self.irho = irho
+        self.rhoM = rhoM
+        self.n_fine = n_fine
+        self.n_fixed = n_fixed
+        self.error_bound = error_bound
+        self.tolerance = tolerance
+        self.q_min = q_min
+        self.z_start = z_start
+
+    @property
+    def n_slabs(self):
+        return len(self.depth)
+
+    @property
+    def saved(self):
+        """ Number of slabs saved with respect to fixed slabs """
+        return self.n_fixed - self.n_slabs
+
+    def stack(self, incident, substrate):
+        """
+            Return depth, rho, irho and sigma for the full stack, including
+            the incident medium and substrate given as (rho, irho).
+            Slab 0 is placed next to the incident medium, as in batch_abeles.
+        """
+        depth = np.concatenate([[0], self.depth, [0]])
+        rho = np.concatenate([[incident[0]], self.rho, [substrate[0]]])
+        irho = np.concatenate([[incident[1]], self.irho, [substrate[1]]])
+        return depth, rho, irho, np.zeros(len(depth) - 1)
+
+    def reversed(self):
+        """ The same slabs in the opposite order """
+        return SliceResult(self.depth[::-1], self.rho[::-1], self.irho[::-1], self.n_fine, self.n_fixed,
+                           self.error_bound, self.tolerance, self.q_min,
+                           z_start=self.z_start + np.sum(self.depth),
+                           rhoM=None if self.rhoM is None else self.rhoM[::-1])
+
+    def profile(self):
+        """
+            Profile of the slabs, with the slab boundaries at even indices and
+            the slab centers at odd indices. This is the format expected by
+            refl1d_model.Accumulator.add().
+            @return: z, rho, irho, rhoM
+        """
+        edges = self.z_start + np.concatenate([[0], np.cumsum(self.depth)])
+        z = np.empty(2 * self.n_slabs + 1)
+        z[0::2] = edges
+        z[1::2] = (edges[:-1] + edges[1:]) / 2.0
+        values = []
+        for v in [self.rho, self.irho, np.zeros(self.n_slabs) if self.rhoM is None else self.rhoM]:
+            padded = np.concatenate([[v[0]], v, [v[-1]]])
+            output = np.empty(len(z))
+            output[1::2] = v
+            output[0::2] = (padded[:-1] + padded[1:]) / 2.0
+            values.append(output)
+        return [z] + values
+
+    def __repr__(self):
+        return "Slabs: %s adaptive vs %s fixed (%s saved, %.0f%%)   |dr| <= %.3g for Q >= %.3g [tolerance %s]" % \
+            (self.n_slabs, self.n_fixed, self.saved, 100.0 * self.saved / max(self.n_fixed, 1),
+             self.error_bound, self.q_min, self.tolerance)
+
+
+def _slab_error(rho, irho, start, stop, dz, q_min, rhoM=None):
+    """ Bound on the change in reflectivity amplitude when [start, stop) is replaced by its mean """
+    r = rho[start:stop]
+    i_r = irho[start:stop]
+    abs_dev = np.abs(r - r.mean()) + np.abs(i_r - i_r.mean())
+    if rhoM is not None:
+        # Each spin state sees rho +/- rhoM
+        r_m = rhoM[start:stop]
+        abs_dev += np.abs(r_m - r_m.mean())
+    distance = dz * np.abs(np.arange(stop - start) - (stop - start - 1) / 2.0)
+    return BORN_FACTOR * dz * min(np.sum(abs_dev) / q_min, np.sum(abs_dev * distance))
+
+
+def adaptive_slices(z, rho, irho=None, tolerance=1e-3, q_min=0.008, dz=2.0, rhoM=None):
+    """
+        Cut a finely sampled profile into slabs of variable width.
+
+        @param z: uniformly spaced positions of the fine profile [A]
+        @param rho: SLD at each position [1e-6/A^2]
+        @param irho: absorption at each position [1e-6/A^2]
+        @param rhoM: magnetic SLD at each position, if the profile is magnetic [1e-6/A^2]
+        @param tolerance: maximum change in reflectivity amplitude for Q >= q_min
+        @param q_min: smallest Q of interest [1/A]
+        @param dz: fixed slab width to compare to [A]
+        @return: SliceResult
+    """
+    z = np.asarray(z, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    irho = np.zeros_like(rho) if irho is None else np.asarray(irho, dtype=float)
+    if rhoM is not None:
+        rhoM = np.asarray(rhoM, dtype=float)
+    n_points = len(z)
+    dz_min = (z[-1] - z[0]) / (n_points - 1)
+
+    # Error allowed per fine sample
+    budget = tolerance / n_points
+
+    # Refine: split segments until each one is within its share of the budget
+    segments = []
+    pending = [(0, n_points)]
+    while pending:
+        start, stop = pending.pop()
+        if stop - start == 1 or _slab_error(rho, irho, start, stop, dz_min, q_min, rhoM) <= budget * (stop - start):
+            segments.append((start, stop))
+        else:
+            middle = (start + stop) // 2
+            pending.append((middle, stop))
+            pending.append((start, middle))
+
+    # Merge: combine neighbours whose union is still within budget
+    merged = [segments[0]]
+    for start, stop in segments[1:]:
+        prev_start = merged[-1][0]
+        if _slab_error(rho, irho, prev_start, stop, dz_min, q_min, rhoM) <= budget * (stop - prev_start):
+            merged[-1] = (prev_start, stop)
+        else:
+            merged.append((start, stop))
+
+    depth = np.asarray([dz_min * (stop - start) for start, stop in merged])
+    rho_slabs = np.asarray([rho[start:stop].mean() for start, stop in merged])
+    irho_slabs = np.asarray([irho[start:stop].mean() for start, stop in merged])
+    rhoM_slabs = None if rhoM is None else np.asarray([rhoM[start:stop].mean() for start, stop in merged])
+    error_bound = sum([_slab_error(rho, irho, start, stop, dz_min, q_min, rhoM) for start, stop in merged])
+    n_fixed = int(np.ceil(n_points * dz_min / dz))
+
+    return SliceResult(depth, rho_slabs, irho_slabs, n_points, n_fixed,
+                       error_bound, tolerance, q_min, z_start=z[0] - dz_min / 2.0, rhoM=rhoM_slabs)
+
+
+def slice_experiment(expt, tolerance=1e-3, q_min=None, dz_min=None, dz=2.0):
+    """
+        Adaptive slices for a non-magnetic refl1d Experiment.
+
+        The profile is taken from the micro-slabs refl1d renders to compute
+        the reflectivity, so the experiment must be created with
+        step_interfaces=True: otherwise rough interfaces are computed with
+        the Nevot-Croce approximation and there is no profile to slice.
+        By default, q_min is the smallest Q of the experiment's probe and
+        dz_min is the slab width of the experiment.
+
+        @return: SliceResult with the surface first, ready for stack()
+    """
+    # refl1d renders the substrate first and the incident medium last
+    expt._render_slabs() #pylint: disable=protected-access
+    slabs = expt._slabs #pylint: disable=protected-access
+    width = np.asarray(slabs.w, dtype=float)
+    rho = np.asarray(slabs.rho, dtype=float)[0]
+    irho = np.asarray(slabs.irho, dtype=float)[0]
+    if np.any(np.asarray(slabs.sigma) > 0):
+        raise ValueError("The experiment has rough interfaces: create it with step_interfaces=True")
+
+    # Sample the slabs between the two media on a uniform grid
+    if dz_min is None:
+        dz_min = expt.dz if expt.dz else np.median(width[1:-1])
+    edges = np.cumsum(width[1:-1])
+    z = np.arange(0, edges[-1], dz_min) + dz_min / 2.0
+    index = 1 + np.minimum(np.searchsorted(edges, z), len(edges) - 1)
+    if q_min is None:
+        q_min = np.min(expt.probe.Q)
+    result = adaptive_slices(z, rho[index], irho[index], tolerance=tolerance, q_min=q_min, dz=dz)
+    return result.reversed()
+
+
+if __name__ == "__main__":
+    from batch_abeles import reflectivity
+
+    parser = argparse.ArgumentParser(description='Compare adaptive and fixed slicing of a rough gold layer')
+    parser.add_argument('-t', metavar='tolerance', type=float, help='tolerance on the reflectivity amplitude',
+                        dest='tolerance', default=1e-3)
+    parser.add_argument('--sigma', type=float, help='gold roughness', dest='sigma', default=105.5)
+    parser.add_argument('--thickness', type=float, help='gold thickness', dest='thickness', default=850)
+    parser.add_argument('--dz', type=float, help='fixed slab width', dest='dz', default=2.0)
+    namespace = parser.parse_args()
+
+    # Gold electrode from the absorption notebook, electrolyte first
+    _depth = [0, 10.0, namespace.thickness, 60, 4.94, 0]
+    _rho = [6.05, 4.0, 4.264, 2.8, 3.025, 2.067]
+    _irho = [0, 0, 0.1, 0, 0, 0]
+    _sigma = [4.963, 1.017, namespace.sigma, 1.6, 2.0]
+
+    q = np.logspace(np.log10(0.005), np.log10(0.1), 200)
+    _z, _rho_z, _irho_z = slab_profile(_depth, _rho, _irho, _sigma, dz=0.25)
+    result = adaptive_slices(_z, _rho_z, _irho_z, tolerance=namespace.tolerance, q_min=q[0], dz=namespace.dz)
+    print(result)
+
+    # Compare to the fine profile and to fixed slabs
+    media = [(_rho[0], _irho[0]), (_rho[-1], _irho[-1])]
+    fine = SliceResult(np.full(len(_z), 0.25), _rho_z, _irho_z, len(_z), len(_z), 0, 0, q[0])
+    n_avg = int(round(namespace.dz / 0.25))
+    n_keep = len(_z) // n_avg * n_avg
+    fixed = SliceResult(np.full(n_keep // n_avg, namespace.dz), _rho_z[:n_keep].reshape(-1, n_avg).mean(axis=1),
+                        _irho_z[:n_keep].reshape(-1, n_avg).mean(axis=1), len(_z), n_keep // n_avg, 0, 0, q[0])
+
+    r_fine = np.sqrt(reflectivity(q / 2.0, *fine.stack(*media)))
+    r_adaptive = np.sqrt(reflectivity(q / 2.0, *result.stack(*media)))
+    r_fixed = np.sqrt(reflectivity(q / 2.0, *fixed.stack(*media)))
+    print("Max |r| change, adaptive: %.3g" % np.max(np.abs(r_adaptive - r_fine)))
+    print("Max |r| change, dz=%s:    %.3g" % (namespace.dz, np.max(np.abs(r_fixed - r_fine))))
@@ -0,0 +1,533 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-return-statements, too-many-branches
+"""
+    Bridge between refl1d models and the JSON used by the webview builder.
+
+    The JSON written by bumps repeats the same boilerplate for every parameter:
+
+        {"id": "...", "name": "THF interface", "fixed": false,
+         "slot": {"value": 43.77, "type": "bumps.parameter.Variable"},
+         "limits": [0.0, "inf"], "bounds": [25.0, 150.0],
+         "distribution": {"type": "bumps.parameter.Uniform"},
+         "discrete": false, "tags": [], "type": "bumps.parameter.Parameter"}
+
+    The compact form keeps only what differs from the defaults:
+
+        {"__class__": "Parameter", "name": "THF interface", "value": 43.77,
+         "fixed": false, "limits": [0.0, "inf"], "bounds": [25.0, 150.0]}
+
+    Both the legacy format above and the current bumps format, where
+    parameters live in a "references" table and the model points to them
+    with {"id": "...", "__class__": "Reference"}, are supported. In the
+    compact form, parameters are always written in place.
+
+    Edits are exchanged as JSON patches (RFC 6902) on the compact form, e.g.
+
+        [{"op": "replace", "path": "/models/0/sample/layers/2/thickness/value", "value": 25}]
+
+    ModelBridge keeps the current model, applies patches by copying only the
+    containers along the patched path, and caches serialized models keyed on
+    their content hash. Unchanged sub-trees keep their serialized form, so
+    re-serializing after a small edit does not re-encode the data arrays.
+
+        python model_json.py ../data/207296_model.json -o 207296_compact.json
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import hashlib
+import json
+import uuid
+from collections import OrderedDict
+
+PARAMETER_TYPE = 'bumps.parameter.Parameter'
+VARIABLE_TYPE = 'bumps.parameter.Variable'
+CALCULATION_TYPE = 'bumps.parameter.Calculation'
+UNIFORM_TYPE = 'bumps.parameter.Uniform'
+REFERENCE_TYPE = 'Reference'
+# Class marker of compact parameters
+COMPACT_TYPE = 'Parameter'
+DEFAULT_LIMITS = ['-inf', 'inf']
+
+# Modules renamed in refl1d 1.0, for models serialized with older versions
+LEGACY_MODULES = [('refl1d.model.', 'refl1d.sample.layers.'),
+                  ('refl1d.material.', 'refl1d.sample.material.'),
+                  ('refl1d.probe.', 'refl1d.probe.probe.')]
+
+
+def _class(obj):
+    """ Class of a serialized object: 'type' in the legacy format, '__class__' in the current one """
+    return obj.get('__class__', obj.get('type')) if isinstance(obj, dict) else None
+
+
+def _is_current_format(doc):
+    """ True for models serialized with a reference table (bumps >= 1.0) """
+    return isinstance(doc, dict) and 'object' in doc and 'references' in doc
+
+
+def _root(doc):
+    """ Serialized FitProblem of a model in either format """
+    return doc['object'] if _is_current_format(doc) else doc
+
+
+def _is_parameter(obj):
+    return _class(obj) == PARAMETER_TYPE
+
+
+def _is_compact_parameter(obj):
+    return isinstance(obj, dict) and obj.get('__class__') == COMPACT_TYPE
+
+
+def _is_reference(obj):
+    return isinstance(obj, dict) and obj.get('__class__') == REFERENCE_TYPE
+
+
+def compact_parameter(par, keep_ids=False):
+    """ Compact form of a serialized bumps parameter """
+    output = OrderedDict([('__class__', COMPACT_TYPE), ('name', par['name'])])
+    slot = par.get('slot') or {}
+    if _class(slot) == CALCULATION_TYPE:
+        output['calculation'] = slot.get('description', '')
+    elif _class(slot) in [VARIABLE_TYPE, None] and 'value' in slot:
+        output['value'] = slot.get('value')
+    else:
+        # Expressions and references to other objects are kept as they are
+        output['slot'] = slot
+    output['fixed'] = par.get('fixed', True)
+    if par.get('limits', DEFAULT_LIMITS) != DEFAULT_LIMITS:
+        output['limits'] = par['limits']
+    if par.get('bounds') is not None:
+        output['bounds'] = par['bounds']
+    if (_class(par.get('distribution')) or UNIFORM_TYPE) != UNIFORM_TYPE:
+        output['distribution'] = par['distribution']
+    if par.get('discrete', False):
+        output['discrete'] = True
+    if par.get('tags'):
+        output['tags'] = par['tags']
+    if keep_ids and 'id' in par:
+        output['id'] = par['id']
+    return output
+
+
+def expand_parameter(par, class_key='type'):
+    """
+        Full bumps form of a compact parameter. Missing ids are generated.
+        @param class_key: 'type' for the legacy format, '__class__' for the current one
+    """
+    if 'calculation' in par:
+        slot = {'description': par['calculation'], class_key: CALCULATION_TYPE}
+    elif 'slot' in par:
+        slot = par['slot']
+    else:
+        slot = {'value': par['value'], class_key: VARIABLE_TYPE}
+    return {'id': par.get('id', str(uuid.uuid4())),
+            'name': par['name'],
+            'fixed': par.get('fixed', True),
+            'slot': slot,
+            'limits': par.get('limits', DEFAULT_LIMITS),
+            'bounds': par.get('bounds'),
+            'distribution': par.get('distribution', {class_key: UNIFORM_TYPE}),
+            'discrete': par.get('discrete', False),
+            'tags': par.get('tags', []),
+            class_key: PARAMETER_TYPE}
+
+
+def _count_references(obj, counts):
+    if _is_reference(obj):
+        counts[obj['id']] = counts.get(obj['id'], 0) + 1
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _count_references(v, counts)
+    elif isinstance(obj, list):
+        for v in obj:
+            _count_references(v, counts)
+    return counts
+
+
+def compact_model(obj, keep_ids=False):
+    """
+        Replace every parameter of a serialized model by its compact form.
+
+        In the current format, references to parameters are replaced by the
+        compact parameter itself, and parameters are removed from the
+        reference table. Parameters used in more than one place keep their id
+        so that they are still shared once expanded.
+    """
+    references = obj['references'] if _is_current_format(obj) else {}
+    counts = _count_references(obj, {}) if references else {}
+
+    def _compact(o):
+        if _is_reference(o) and _is_parameter(references.get(o['id'])):
+            o = references[o['id']]
+        if _is_parameter(o):
+            par = compact_parameter(o, keep_ids=keep_ids or counts.get(o.get('id'), 0) > 1)
+            if 'slot' in par:
+                par['slot'] = _compact(par['slot'])
+            return par
+        if isinstance(o, dict):
+            return OrderedDict((k, _compact(v)) for k, v in o.items())
+        if isinstance(o, list):
+            return [_compact(v) for v in o]
+        return o
+
+    if not references:
+        return _compact(obj)
+    output = OrderedDict()
+    for key, value in obj.items():
+        if key == 'references':
+            output[key] = OrderedDict((k, _compact(v)) for k, v in value.items() if not _is_parameter(v))
+        else:
+            output[key] = _compact(value)
+    return output
+
+
+def expand_model(obj, inline=False):
+    """
+        Inverse of compact_model().
+
+        @param inline: if True, parameters of the current format are expanded in
+                       place instead of being moved to the reference table.
+                       This is the form the webview builder displays.
+    """
+    current = _is_current_format(obj)
+    class_key = '__class__' if current else 'type'
+    references = OrderedDict()
+
+    def _expand(o):
+        if _is_compact_parameter(o):
+            par = expand_parameter(o, class_key=class_key)
+            par['slot'] = _expand(par['slot'])
+            if inline or not current:
+                return par
+            references[par['id']] = par
+            return {'id': par['id'], '__class__': REFERENCE_TYPE}
+        if isinstance(o, dict):
+            return dict((k, _expand(v)) for k, v in o.items())
+        if isinstance(o, list):
+            return [_expand(v) for v in o]
+        return o
+
+    if not current:
+        return _expand(obj)
+    output = dict((k, _expand(v)) for k, v in obj.items())
+    output['references'].update(references)
+    return output
+
+
+def _rename_legacy_modules(obj):
+    """ Class names of a legacy model for refl1d >= 1.0 """
+    if isinstance(obj, dict):
+        output = dict((k, _rename_legacy_modules(v)) for k, v in obj.items())
+        for old, new in LEGACY_MODULES:
+            if isinstance(output.get('type'), str) and output['type'].startswith(old):
+                output['type'] = new + output['type'][len(old):]
+        return output
+    if isinstance(obj, list):
+        return [_rename_legacy_modules(v) for v in obj]
+    return obj
+
+
+def to_refl1d(doc):
+    """ Build the refl1d/bumps objects for a model, compact or not """
+    from bumps.serialize import deserialize
+    doc = expand_model(doc)
+    if not _is_current_format(doc):
+        try:
+            import refl1d.material #pylint: disable=unused-variable
+        except ImportError:
+            doc = _rename_legacy_modules(doc)
+    return deserialize(doc)
+
+
+def from_refl1d(problem, keep_ids=False):
+    """ Compact JSON model for a bumps FitProblem """
+    from bumps.serialize import serialize
+    return compact_model(json.loads(json.dumps(serialize(problem))), keep_ids=keep_ids)
+
+
+def from_problem(problem):
+    """
+        Compact JSON model for a ReflectivityProblem parsed from a .err file.
+        Only the layer parameters are available from the log.
+    """
+    def _parameter(name, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            pass
+        return OrderedDict([('__class__', COMPACT_TYPE), ('name', name), ('value', value), ('fixed', True)])
+
+    models = []
+    for name, model in problem.model_list.items():
+        layers = []
+        for layer_name, parameters in model.layers.items():
+            layer = OrderedDict(name=layer_name)
+            for par_name in sorted(parameters.keys()):
+                key = '_'.join(par_name.replace(layer_name, '', 1).split())
+                layer[key] = _parameter(par_name, parameters[par_name])
+            layers.append(layer)
+        models.append(OrderedDict(name=name, chi2=model.chi2, sample=OrderedDict(layers=layers)))
+    return OrderedDict(name=problem.file_path, models=models)
+
+
+# JSON patches ################################################################
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def _escape(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def _split_pointer(pointer):
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise ValueError("Invalid JSON pointer: %s" % pointer)
+    return [_unescape(t) for t in pointer[1:].split('/')]
+
+
+def _key(container, token):
+    if isinstance(container, list):
+        return len(container) if token == '-' else int(token)
+    return token
+
+
+def _get(doc, tokens):
+    for token in tokens:
+        doc = doc[_key(doc, token)]
+    return doc
+
+
+def _copy_path(doc, tokens):
+    """
+        Shallow-copy the containers from the root down to the parent of the
+        last token, so that the original document is left untouched.
+        Returns the new root and the copied parent.
+    """
+    root = _shallow_copy(doc)
+    parent = root
+    for token in tokens[:-1]:
+        key = _key(parent, token)
+        parent[key] = _shallow_copy(parent[key])
+        parent = parent[key]
+    return root, parent
+
+
+def _shallow_copy(obj):
+    if isinstance(obj, OrderedDict):
+        return OrderedDict(obj)
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, list):
+        return list(obj)
+    raise ValueError("Cannot patch inside a %s" % type(obj).__name__)
+
+
+def _add(doc, tokens, value):
+    if not tokens:
+        return value
+    root, parent = _copy_path(doc, tokens)
+    key = _key(parent, tokens[-1])
+    if isinstance(parent, list):
+        parent.insert(key, value)
+    else:
+        parent[key] = value
+    return root
+
+
+def _remove(doc, tokens):
+    root, parent = _copy_path(doc, tokens)
+    del parent[_key(parent, tokens[-1])]
+    return root
+
+
+def _replace(doc, tokens, value):
+    if not tokens:
+        return value
+    root, parent = _copy_path(doc, tokens)
+    key = _key(parent, tokens[-1])
+    if isinstance(parent, dict) and key not in parent:
+        raise KeyError("Cannot replace missing member %s" % key)
+    parent[key] = value
+    return root
+
+
+def apply_patch(doc, patch):
+    """
+        Apply a JSON patch (RFC 6902) and return the new document.
+        The original document is not modified, and the new document shares
+        all the sub-trees that the patch does not touch.
+    """
+    for operation in patch:
+        op = operation['op']
+        tokens = _split_pointer(operation['path'])
+        if op == 'add':
+            doc = _add(doc, tokens, operation['value'])
+        elif op == 'remove':
+            doc = _remove(doc, tokens)
+        elif op == 'replace':
+            doc = _replace(doc, tokens, operation['value'])
+        elif op == 'move':
+            from_tokens = _split_pointer(operation['from'])
+            value = _get(doc, from_tokens)
+            doc = _add(_remove(doc, from_tokens), tokens, value)
+        elif op == 'copy':
+            doc = _add(doc, tokens, _get(doc, _split_pointer(operation['from'])))
+        elif op == 'test':
+            if _get(doc, tokens) != operation['value']:
+                raise ValueError("Patch test failed at %s" % operation['path'])
+        else:
+            raise ValueError("Unknown patch operation: %s" % op)
+    return doc
+
+
+def make_patch(old, new, path=''):
+    """
+        Compute a JSON patch that turns old into new.
+        Lists of different lengths are replaced as a whole.
+    """
+    if old is new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old:
+            if key not in new:
+                patch.append(dict(op='remove', path='%s/%s' % (path, _escape(key))))
+        for key in new:
+            if key not in old:
+                patch.append(dict(op='add', path='%s/%s' % (path, _escape(key)), value=new[key]))
+            else:
+                patch.extend(make_patch(old[key], new[key], '%s/%s' % (path, _escape(key))))
+        return patch
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        patch = []
+        for i, (o, n) in enumerate(zip(old, new)):
+            patch.extend(make_patch(o, n, '%s/%d' % (path, i)))
+        return patch
+    if type(old) is type(new) and old == new: #pylint: disable=unidiomatic-typecheck
+        return []
+    return [dict(op='replace', path=path, value=new)]
+
+
+# Serialization ###############################################################
+
+def _is_scalar(obj):
+    return obj is None or isinstance(obj, (bool, int, float, str))
+
+
+def _dumps(obj, memo, new_memo):
+    """
+        Canonical compact JSON, reusing the serialized form of containers
+        that were already serialized. Containers are never modified in place
+        by the bridge, so a container that is still the same object has the
+        same serialized form.
+    """
+    if _is_scalar(obj):
+        return json.dumps(obj)
+    cached = memo.get(id(obj))
+    if cached is not None and cached[0] is obj:
+        new_memo[id(obj)] = cached
+        return cached[1]
+
+    if isinstance(obj, dict):
+        text = '{%s}' % ','.join('%s:%s' % (json.dumps(k), _dumps(obj[k], memo, new_memo)) for k in sorted(obj))
+    elif all(_is_scalar(v) for v in obj):
+        text = json.dumps(obj, separators=(',', ':'))
+    else:
+        text = '[%s]' % ','.join(_dumps(v, memo, new_memo) for v in obj)
+    new_memo[id(obj)] = (obj, text)
+    return text
+
+
+class ModelBridge(object):
+    """
+        Current state of a model edited from the webview builder.
+
+        @param doc: serialized model, in full bumps form or compact form
+        @param cache_size: number of serialized versions to keep
+    """
+    def __init__(self, doc, cache_size=32):
+        self.doc = compact_model(doc)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._memo = {}
+        self.version = None
+        self.export()
+
+    @classmethod
+    def from_file(cls, file_path, **kwargs):
+        with open(file_path, 'r') as fd:
+            return cls(json.load(fd), **kwargs)
+
+    def export(self):
+        """
+            Serialize the current model.
+            @return: content hash and compact JSON text
+        """
+        new_memo = {}
+        text = _dumps(self.doc, self._memo, new_memo)
+        self._memo = new_memo
+        version = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        self._store(version, self.doc, text)
+        self.version = version
+        return version, text
+
+    def _store(self, version, doc, text):
+        if version in self._cache:
+            self._cache.pop(version)
+        self._cache[version] = (doc, text)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, version):
+        """ Return the compact JSON text of a cached version """
+        return self._cache[version][1]
+
+    def apply(self, patch, base_version=None):
+        """
+            Apply a JSON patch to the model.
+
+            @param patch: list of patch operations on the compact model
+            @param base_version: version the patch was computed against. It must
+                                 be a cached version; by default the current one.
+            @return: new content hash and compact JSON text
+        """
+        if base_version is None or base_version == self.version:
+            base = self.doc
+        elif base_version in self._cache:
+            base = self._cache[base_version][0]
+        else:
+            raise KeyError("Unknown model version %s" % base_version)
+        self.doc = apply_patch(base, patch)
+        return self.export()
+
+    def diff(self, version):
+        """ Patch that brings a cached version up to date """
+        if version not in self._cache:
+            raise KeyError("Unknown model version %s" % version)
+        return make_patch(self._cache[version][0], self.doc)
+
+    def layers(self, model_index=0):
+        """ Layers of one of the models, as a list of compact dictionaries """
+        return _root(self.doc)['models'][model_index]['sample']['layers']
+
+    def to_refl1d(self):
+        return to_refl1d(self.doc)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write the compact form of a serialized refl1d model')
+    parser.add_argument('model', help='serialized model (.json)')
+    parser.add_argument('-o', metavar='output_name', help='name of the output file',
+                        dest='output_name', default=None)
+    namespace = parser.parse_args()
+
+    with open(namespace.model, 'r') as _fd:
+        original = _fd.read()
+    bridge = ModelBridge(json.loads(original))
+    _version, compact_text = bridge.export()
+    print("Model %s: %s bytes -> %s bytes compact" % (_version[:12], len(original), len(compact_text)))
+
+    if namespace.output_name is not None:
+        with open(namespace.output_name, 'w') as _fd:
+            _fd.write(compact_text)
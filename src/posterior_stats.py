@@ -0,0 +1,209 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-locals, too-many-arguments, too-many-instance-attributes
+"""
+    Statistics of DREAM posterior draws for all parameters at once.
+
+    This replaces the per-parameter use of dream.stats.var_stats and the
+    make_logp_histogram function of the error_analysis notebook. Each parameter
+    column is sorted once, and the sorted values are used for the credible
+    intervals, the median and the logp-binned histogram.
+
+    The draw is processed in blocks of columns and chunks of rows, so that
+    the points can be a memory-mapped array that does not fit in memory:
+
+        points = np.load('draw_points.npy', mmap_mode='r')
+        stats = PosteriorStats(points, logp, labels=problem.labels())
+        print(stats)
+
+    From a bumps MCMC state:
+
+        state = dream.state.load_state(file_path)
+        state.mark_outliers()
+        stats = stats_from_draw(state.draw(), labels=problem.labels())
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+QUANTILE_LEVELS = (0.025, 0.16, 0.5, 0.84, 0.975)
+
+
+class ParameterStats(object):
+    """ Statistics for a single parameter, following bumps.dream.stats.VarStats """
+    def __init__(self, label, index, mean, median, std, best, p68_range, p95_range):
+        self.label = label
+        self.index = index
+        self.mean = mean
+        self.median = median
+        self.std = std
+        self.best = best
+        self.p68_range = p68_range
+        self.p95_range = p95_range
+        self.histogram = None
+
+    def __repr__(self):
+        return "%3d %20s %12.6g %12.6g %12.6g %12.6g [%12.6g %12.6g] [%12.6g %12.6g]" % \
+            (self.index + 1, self.label, self.mean, self.median, self.std, self.best,
+             self.p68_range[0], self.p68_range[1], self.p95_range[0], self.p95_range[1])
+
+
+def _weighted_quantiles(sorted_values, sorted_weights, levels):
+    """
+        Quantiles of each column of a sorted [N, k] array.
+        The cumulative weight is taken at the middle of each point,
+        and the quantiles are linearly interpolated between points.
+    """
+    cdf = np.cumsum(sorted_weights, axis=0)
+    total = cdf[-1]
+    cdf -= 0.5 * sorted_weights
+    cdf /= total
+
+    n_points, n_cols = sorted_values.shape
+    cols = np.arange(n_cols)
+    output = np.empty((len(levels), n_cols))
+    for i, level in enumerate(levels):
+        upper = np.clip(np.sum(cdf < level, axis=0), 1, n_points - 1)
+        lower = upper - 1
+        c_low, c_high = cdf[lower, cols], cdf[upper, cols]
+        v_low, v_high = sorted_values[lower, cols], sorted_values[upper, cols]
+        span = c_high - c_low
+        fraction = np.clip(np.where(span > 0, (level - c_low) / np.where(span > 0, span, 1), 0), 0, 1)
+        output[i] = v_low + fraction * (v_high - v_low)
+    return output
+
+
+def _logp_histograms(sorted_values, sorted_weights, sorted_logp, low, high, nbins, max_logp):
+    """
+        Weighted histograms of each sorted column between low and high, along
+        with the maximum likelihood found in each bin.
+
+        Since the columns are sorted, the bin index is non-decreasing along each
+        column and the bins can be reduced with reduceat instead of sorting again.
+        Points outside [low, high] go in an underflow and an overflow bin.
+    """
+    n_points, n_cols = sorted_values.shape
+    width = np.where(high > low, high - low, 1.0)
+    bins = np.floor((sorted_values - low) / width * nbins).astype(np.int64)
+    bins = np.clip(bins, -1, nbins) + 1
+    # Include the upper edge in the last bin, like numpy.histogram
+    bins[(sorted_values == high) & (high > low)] = nbins
+    flat_ids = (bins + (nbins + 2) * np.arange(n_cols)).ravel(order='F')
+
+    starts = np.flatnonzero(np.r_[True, flat_ids[1:] != flat_ids[:-1]])
+    ids = flat_ids[starts]
+    heights = np.zeros(n_cols * (nbins + 2))
+    best_logp = np.full(n_cols * (nbins + 2), -np.inf)
+    heights[ids] = np.add.reduceat(sorted_weights.ravel(order='F'), starts)
+    best_logp[ids] = np.maximum.reduceat(sorted_logp.ravel(order='F'), starts)
+
+    heights = heights.reshape(n_cols, nbins + 2)[:, 1:-1]
+    heights /= sorted_weights.sum(axis=0)[:, None]
+    maxlikelihood = np.exp(best_logp.reshape(n_cols, nbins + 2)[:, 1:-1] - max_logp)
+
+    # Normalize the maximum likelihood so it contains the same area as the
+    # histogram, unless it is really spikey, in which case make sure it has
+    # about the same height as the histogram.
+    ml_sum = maxlikelihood.sum(axis=1)
+    scale = np.where(ml_sum > 0, heights.sum(axis=1) / np.where(ml_sum > 0, ml_sum, 1), 0)
+    maxlikelihood *= scale[:, None]
+    hist_peak = heights.max(axis=1)
+    ml_peak = maxlikelihood.max(axis=1)
+    spikey = ml_peak > hist_peak * 1.3
+    maxlikelihood[spikey] *= (hist_peak[spikey] * 1.3 / ml_peak[spikey])[:, None]
+
+    edges = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, nbins + 1)[None, :]
+    centers = (edges[:, 1:] + edges[:, :-1]) / 2.0
+    return centers, heights, maxlikelihood
+
+
+class PosteriorStats(object):
+    """
+        Statistics for all the parameters of a posterior draw.
+
+        @param points: [n_draws, n_pars] array of parameter values (can be memory-mapped)
+        @param logp: log likelihood of each draw
+        @param weights: weight of each draw, or None for equal weights
+        @param labels: parameter names
+        @param nbins: number of bins for the logp histograms
+        @param max_memory: approximate memory, in bytes, to use when processing a block of columns
+        @param row_chunk: number of rows per chunk when computing the correlation matrix
+    """
+    def __init__(self, points, logp, weights=None, labels=None, nbins=30,
+                 max_memory=512*1024**2, row_chunk=100000):
+        self.n_draws, self.n_pars = points.shape
+        self.logp = np.asarray(logp, dtype=float)
+        self.weights = np.ones(self.n_draws) if weights is None else np.asarray(weights, dtype=float)
+        self.labels = labels if labels is not None else ['p%d' % i for i in range(self.n_pars)]
+        self.nbins = nbins
+
+        self.mean = np.empty(self.n_pars)
+        self.std = np.empty(self.n_pars)
+        self.best = np.empty(self.n_pars)
+        self.quantile_levels = QUANTILE_LEVELS
+        self.quantiles = np.empty((len(QUANTILE_LEVELS), self.n_pars))
+        self.hist_centers = np.empty((self.n_pars, nbins))
+        self.hist_heights = np.empty((self.n_pars, nbins))
+        self.hist_maxlikelihood = np.empty((self.n_pars, nbins))
+
+        # Each column of a block needs its values, sort index, sorted values,
+        # weights, logp and cumulative weights
+        block_size = int(max(1, min(self.n_pars, max_memory // (6 * 8 * max(self.n_draws, 1)))))
+        for start in range(0, self.n_pars, block_size):
+            self._process_block(points, slice(start, min(start + block_size, self.n_pars)))
+
+        self.correlation = self._correlation(points, row_chunk)
+        self.parameters = []
+        for i in range(self.n_pars):
+            par = ParameterStats(self.labels[i], i, self.mean[i], self.quantiles[2, i], self.std[i], self.best[i],
+                                 (self.quantiles[1, i], self.quantiles[3, i]),
+                                 (self.quantiles[0, i], self.quantiles[4, i]))
+            par.histogram = (self.hist_centers[i], self.hist_heights[i], self.hist_maxlikelihood[i])
+            self.parameters.append(par)
+
+    def _process_block(self, points, cols):
+        """ Compute the statistics for a block of columns """
+        values = np.asarray(points[:, cols], dtype=float)
+        total = self.weights.sum()
+        self.mean[cols] = np.dot(self.weights, values) / total
+        self.std[cols] = np.sqrt(np.dot(self.weights, (values - self.mean[cols])**2) / total)
+        self.best[cols] = values[np.argmax(self.logp)]
+
+        # Single sort of each column
+        idx = np.argsort(values, axis=0, kind='stable')
+        values = np.take_along_axis(values, idx, axis=0)
+        weights = self.weights[idx]
+        self.quantiles[:, cols] = _weighted_quantiles(values, weights, self.quantile_levels)
+
+        centers, heights, maxlikelihood = _logp_histograms(values, weights, self.logp[idx],
+                                                           self.quantiles[0, cols], self.quantiles[-1, cols],
+                                                           self.nbins, self.logp.max())
+        self.hist_centers[cols] = centers
+        self.hist_heights[cols] = heights
+        self.hist_maxlikelihood[cols] = maxlikelihood
+
+    def _correlation(self, points, row_chunk):
+        """ Weighted correlation matrix, accumulated over chunks of rows """
+        covariance = np.zeros((self.n_pars, self.n_pars))
+        for start in range(0, self.n_draws, row_chunk):
+            stop = min(start + row_chunk, self.n_draws)
+            centered = np.asarray(points[start:stop], dtype=float) - self.mean
+            covariance += np.dot(centered.T * self.weights[start:stop], centered)
+        covariance /= self.weights.sum()
+        sigma = np.sqrt(np.diag(covariance))
+        sigma[sigma == 0] = 1
+        return covariance / np.outer(sigma, sigma)
+
+    def __getitem__(self, index):
+        return self.parameters[index]
+
+    def __repr__(self):
+        printout = "%3s %20s %12s %12s %12s %12s %27s %27s\n" % \
+            ('', 'Parameter', 'mean', 'median', 'std', 'best', '68% interval', '95% interval')
+        for par in self.parameters:
+            printout += "%s\n" % par
+        return printout
+
+
+def stats_from_draw(drawn, labels=None, **kwargs):
+    """
+        Compute statistics from a bumps draw, as returned by state.draw()
+    """
+    return PosteriorStats(drawn.points, drawn.logp, weights=drawn.weights, labels=labels, **kwargs)
@@ -0,0 +1,265 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-instance-attributes, too-many-arguments
+"""
+    Preview service for the webview layer builder.
+
+    The builder posts its list of layers and gets back the smooth SLD profile
+    and the reflectivity of the stack. Results are memoized by a hash of the
+    layer stack, so going back to a previous arrangement is free.
+
+    Dragging layers around produces bursts of requests. Each client's requests
+    are debounced: a request waits for a short quiet period, and is dropped
+    if a newer request from the same client arrives in the meantime. Requests
+    for a stack that is already being computed wait for that computation
+    instead of starting a new one. A burst of edits therefore leads to at most
+    one computation.
+
+    The server can also stand in for webview/server/server.js, serving the
+    model to the builder and accepting edits as JSON patches (see model_json.py):
+
+        python preview_service.py -m ../data/207296_model.json -p 3001
+
+        GET   /api/testdata   model, in full form
+        GET   /api/model      model, in compact form
+        PATCH /api/model      apply a JSON patch to the model
+        POST  /api/preview    {"client": "...", "layers": [...]} -> profile and R(Q)
+
+    The builder talks to http://localhost:3001 by default; another server can
+    be given with simple_builder.html?server=http://host:port. Its edits are
+    sent back to the model as patches against the last version it saw.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from batch_abeles import reflectivity
+from microslice import slab_profile
+from model_json import ModelBridge, expand_model
+
+
+def _value(par):
+    """ Value of a parameter in full bumps form, compact form, or as a number """
+    if isinstance(par, dict):
+        par = par['slot']['value'] if 'slot' in par else par['value']
+    return float(par)
+
+
+def layer_stack(layers):
+    """
+        Convert the builder's layer list to arrays for batch_abeles.
+
+        The builder follows the refl1d Stack order, where the first layer is
+        the substrate, the last one is the incident medium, and the interface of
+        a layer is the roughness at its top. Layers with an 'order' entry are
+        sorted by it first.
+
+        @return: names, depth, rho, irho, sigma with the surface at index 0
+    """
+    if len(layers) < 2:
+        raise ValueError("The stack needs at least two layers: a substrate and an incident medium")
+    if any('order' in layer for layer in layers):
+        layers = sorted(layers, key=lambda layer: float(layer.get('order', 0)))
+    names = [layer['name'] for layer in layers][::-1]
+    depth = np.asarray([_value(layer['thickness']) for layer in layers])[::-1]
+    rho = np.asarray([_value(layer['material']['rho']) for layer in layers])[::-1]
+    irho = np.asarray([_value(layer['material']['irho']) for layer in layers])[::-1]
+    sigma = np.asarray([_value(layer['interface']) for layer in layers[:-1]])[::-1]
+    return names, depth, rho, irho, sigma
+
+
+class PreviewService(object):
+    """
+        Memoized and debounced computation of SLD profiles and reflectivity.
+
+        @param q_min, q_max, n_q: Q range of the reflectivity
+        @param dz: step of the SLD profile
+        @param debounce: quiet period, in seconds, before a request is computed
+        @param cache_size: number of results to keep
+    """
+    def __init__(self, q_min=0.008, q_max=0.2, n_q=200, dz=1.0, debounce=0.02, cache_size=256):
+        self.q = np.logspace(np.log10(q_min), np.log10(q_max), n_q)
+        self.dz = dz
+        self.debounce = debounce
+        self.cache_size = cache_size
+        self.n_computed = 0
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._latest = {}
+
+        # Load everything needed for a computation before the first request
+        self.compute([{'name': 'Si', 'thickness': 0, 'interface': 1, 'material': {'rho': 2.07, 'irho': 0}},
+                      {'name': 'air', 'thickness': 0, 'interface': 0, 'material': {'rho': 0, 'irho': 0}}])
+
+    def key(self, layers):
+        """ Hash of the layer stack """
+        stack = layer_stack(layers)
+        text = json.dumps([stack[0]] + [a.tolist() for a in stack[1:]])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def compute(self, layers):
+        """ Compute the SLD profile and reflectivity of a layer stack """
+        names, depth, rho, irho, sigma = layer_stack(layers)
+        z, rho_z, irho_z = slab_profile(depth, rho, irho, sigma, dz=self.dz)
+        r = reflectivity(self.q / 2.0, depth, rho, irho=irho, sigma=sigma)
+        return OrderedDict(layers=names, z=z.tolist(), rho=rho_z.tolist(), irho=irho_z.tolist(),
+                           q=self.q.tolist(), r=r.tolist())
+
+    def request(self, layers, client=None):
+        """
+            Return the preview for a layer stack.
+
+            @param layers: builder layer list
+            @param client: identifier used to debounce a client's requests
+            @return: result dictionary, or None if a newer request from the same
+                     client superseded this one
+        """
+        key = self.key(layers)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)
+                return self._cache[key]
+            ticket = object()
+            if client is not None:
+                self._latest[client] = ticket
+
+        if client is not None and self.debounce > 0:
+            time.sleep(self.debounce)
+            with self._lock:
+                if self._latest.get(client) is not ticket:
+                    return None
+
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = self._in_flight[key] = [threading.Event(), None, None]
+
+        if not owner:
+            in_flight[0].wait()
+            if in_flight[2] is not None:
+                raise in_flight[2]
+            return in_flight[1]
+
+        try:
+            t0 = time.time()
+            result = self.compute(layers)
+            result['key'] = key
+            result['time'] = time.time() - t0
+            self.n_computed += 1
+            in_flight[1] = result
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        except Exception as error:
+            # Requests waiting on this computation get the same error
+            in_flight[2] = error
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key)
+                if client is not None and self._latest.get(client) is ticket:
+                    del self._latest[client]
+            in_flight[0].set()
+        return result
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(service, bridge=None):
+    """ Request handler class for a preview service and an optional model bridge """
+    class PreviewHandler(BaseHTTPRequestHandler):
+        def _send(self, code, text):
+            data = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+
+        def do_OPTIONS(self):
+            self.send_response(204)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, PATCH, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+            self.end_headers()
+
+        def do_GET(self):
+            if bridge is not None and self.path == '/api/testdata':
+                self._send(200, json.dumps(expand_model(bridge.doc, inline=True)))
+            elif bridge is not None and self.path == '/api/model':
+                version, text = bridge.export()
+                self._send(200, '{"version":%s,"model":%s}' % (json.dumps(version), text))
+            else:
+                self._send(404, '{"error":"not found"}')
+
+        def do_PATCH(self):
+            if bridge is None or self.path != '/api/model':
+                self._send(404, '{"error":"not found"}')
+                return
+            try:
+                body = self._read_json()
+                version, _ = bridge.apply(body['patch'], base_version=body.get('version'))
+                self._send(200, json.dumps(dict(version=version)))
+            except (KeyError, ValueError, IndexError) as error:
+                self._send(409, json.dumps(dict(error=str(error))))
+
+        def do_POST(self):
+            if self.path != '/api/preview':
+                self._send(404, '{"error":"not found"}')
+                return
+            try:
+                body = self._read_json()
+                result = service.request(body['layers'], client=body.get('client'))
+            except (KeyError, ValueError, TypeError) as error:
+                self._send(400, json.dumps(dict(error=str(error))))
+                return
+            if result is None:
+                self._send(200, '{"superseded":true}')
+            else:
+                self._send(200, json.dumps(result))
+
+        def log_message(self, format, *args): #pylint: disable=redefined-builtin
+            logging.debug(format, *args)
+
+    return PreviewHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SLD and reflectivity preview server for the layer builder')
+    parser.add_argument('-p', metavar='port', type=int, help='port to listen on', dest='port', default=3001)
+    parser.add_argument('-m', metavar='model', help='serialized model to serve to the builder',
+                        dest='model_path', default=None)
+    parser.add_argument('--debounce', type=float, help='quiet period before computing, in seconds',
+                        dest='debounce', default=0.02)
+    namespace = parser.parse_args()
+
+    preview = PreviewService(debounce=namespace.debounce)
+    model_bridge = ModelBridge.from_file(namespace.model_path) if namespace.model_path else None
+    server = ThreadingHTTPServer(('localhost', namespace.port), make_handler(preview, model_bridge))
+    print("Preview server running on port %s" % namespace.port)
+    server.serve_forever()
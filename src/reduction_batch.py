@@ -0,0 +1,352 @@
+#pylint: disable=missing-docstring, line-too-long, invalid-name, too-many-locals, too-many-arguments, global-statement
+"""
+    Check the peak ranges of many reduced runs at once.
+
+    The reduction settings written in the header of reduced REF_M files are
+    read for every file in a set of directories, and the reflectivity peak and
+    low-resolution range of each run are found again and compared to the
+    ranges used for the reduction. This is the batch version of
+    read_settings() and process_run() in notebooks/plot_utils.py.
+
+    Headers are read line by line, and reading stops at the start of the data
+    block, so large files cost no more than small ones. Each run is only
+    processed once, even if it is used by several files, and runs are spread
+    over a process pool.
+
+    When Mantid is available, peaks are found with LRPeakSelection as in
+    plot_utils.find_peaks(). Otherwise the event data are histogrammed from
+    the Nexus file with h5py, and peaks are found on the 304x256 detector
+    array with find_peaks_array().
+
+        python reduction_batch.py -d /SNS/REF_M/IPTS-21391/nexus -o peaks.csv /SNS/REF_M/IPTS-21391/shared/autoreduce
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import csv
+import fnmatch
+import functools
+import glob
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+
+N_X_PIXELS = 304
+N_Y_PIXELS = 256
+
+DIRECT_BEAM_HEADERS = ['#', 'DB_ID', 'P0', 'PN', 'x_pos', 'x_width',
+                       'y_pos', 'y_width', 'bg_pos', 'bg_width',
+                       'dpix', 'tth', 'number', 'File']
+DATA_RUN_HEADERS = ['#', 'scale', 'P0', 'PN', 'x_pos', 'x_width',
+                    'y_pos', 'y_width', 'bg_pos', 'bg_width',
+                    'extract_fan', 'dpix', 'tth', 'number', 'DB_ID', 'File']
+
+# Loader used by each worker process
+_LOADER = None
+
+
+def _convert(name, value):
+    """ Convert a settings entry to its type, as in plot_utils.fill_dict() """
+    if name in ['#', 'File']:
+        return value
+    if name in ['DB_ID', 'P0', 'PN', 'dpix', 'number']:
+        return int(value)
+    if name == 'extract_fan':
+        return value == 'True'
+    return float(value)
+
+
+def parse_settings(lines):
+    """
+        Parse the reduction settings from the lines of a reduced file.
+        Parsing stops at the start of the data.
+
+        @param lines: iterable of lines, such as an open file
+        @return: dictionary with the same content as plot_utils.read_settings()
+    """
+    reduction_settings = {'direct_beam_runs': [], 'data_runs': [], 'process_type': 'Specular'}
+    headers = None
+    for line in lines:
+        if "# Type:" in line:
+            reduction_settings['process_type'] = line.strip().split()[2]
+        elif "[Direct Beam Runs]" in line:
+            headers, runs = DIRECT_BEAM_HEADERS, reduction_settings['direct_beam_runs']
+        elif "[Data Runs]" in line:
+            headers, runs = DATA_RUN_HEADERS, reduction_settings['data_runs']
+        elif "[Data]" in line:
+            break
+        elif not line.startswith('#'):
+            # Data without a [Data] marker
+            if line.strip():
+                break
+        elif headers is not None:
+            toks = line.strip().split()
+            # Skip the column names
+            if len(toks) == len(headers) and toks[1] != headers[1]:
+                runs.append(dict((name, _convert(name, value)) for name, value in zip(headers, toks)))
+    return reduction_settings
+
+
+def read_settings(file_path):
+    """ Read the reduction settings of a reduced file """
+    with open(file_path, 'r') as fd:
+        return parse_settings(fd)
+
+
+def scan_settings(top_dirs, patterns=('*.dat', '*.txt')):
+    """
+        Read the reduction settings of all the reduced files in a set of directories.
+        Files without any run in their header are skipped.
+
+        @param top_dirs: list of directories to crawl
+        @param patterns: file name patterns of reduced files
+        @return: generator of (file path, settings)
+    """
+    for top_dir in top_dirs:
+        for root, dirs, files in os.walk(top_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if not any(fnmatch.fnmatch(name, p) for p in patterns):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    settings = read_settings(file_path)
+                except (IOError, ValueError, UnicodeDecodeError) as error:
+                    logging.warning("Could not read %s: %s", file_path, error)
+                    continue
+                if settings['data_runs'] or settings['direct_beam_runs']:
+                    yield file_path, settings
+
+
+def _peak_range(profile, threshold):
+    """
+        Range of the peak around the maximum of a profile.
+        The peak extends as long as the smoothed profile stays above the
+        background plus a fraction of the peak height. The background is the
+        median of the profile.
+    """
+    profile = np.asarray(profile, dtype=float)
+    smoothed = np.convolve(profile, np.ones(3) / 3.0, mode='same')
+    background = np.median(smoothed)
+    i_max = int(np.argmax(smoothed))
+    above = smoothed > background + threshold * (smoothed[i_max] - background)
+    below = np.flatnonzero(~above)
+    left = below[below < i_max]
+    right = below[below > i_max]
+    return (int(left[-1]) + 1 if len(left) else 0,
+            int(right[0]) - 1 if len(right) else len(profile) - 1)
+
+
+def find_peaks_array(counts, x_min=50, x_max=250, y_max=250, threshold=0.1):
+    """
+        Find the reflectivity peak and low-resolution range on a detector array.
+        This is the NumPy equivalent of plot_utils.find_peaks().
+
+        @param counts: [304, 256] array of counts, indexed by x and y pixel
+        @param x_min, x_max: x pixel range to look for the peak in
+        @param y_max: largest y pixel for the low-resolution range
+        @param threshold: fraction of the peak height above background that defines the range
+        @return: (x_peak_min, x_peak_max), (y_min, y_max)
+    """
+    counts = np.asarray(counts)
+    if counts.shape != (N_X_PIXELS, N_Y_PIXELS):
+        raise ValueError("Detector array has shape %s, expected (%s, %s)" % (counts.shape, N_X_PIXELS, N_Y_PIXELS))
+    x_lo, x_hi = _peak_range(counts[x_min:x_max + 1].sum(axis=1), threshold)
+    y_peak = _peak_range(counts[:, :y_max + 1].sum(axis=0), threshold)
+    return (x_lo + x_min, x_hi + x_min), y_peak
+
+
+def load_detector(run_number, data_dir, instrument='REF_M', entry='entry-Off_Off'):
+    """
+        Histogram the events of a run on the detector, without Mantid.
+        Pixel IDs are x * 256 + y, as assumed by RefRoi with NXPixel=304 and NYPixel=256.
+
+        @return: [304, 256] counts, DIRPIX
+    """
+    import h5py
+
+    candidates = sorted(glob.glob(os.path.join(data_dir, '%s_%s.nxs*' % (instrument, run_number))))
+    if not candidates:
+        raise IOError("No data file for %s_%s in %s" % (instrument, run_number, data_dir))
+    with h5py.File(candidates[0], 'r') as nexus:
+        event_id = nexus['%s/bank1/event_id' % entry][()]
+        dirpix = float(nexus['%s/DASlogs/DIRPIX/value' % entry][0])
+    event_id = event_id[(event_id >= 0) & (event_id < N_X_PIXELS * N_Y_PIXELS)]
+    counts = np.bincount(event_id, minlength=N_X_PIXELS * N_Y_PIXELS)
+    return counts.reshape(N_X_PIXELS, N_Y_PIXELS), dirpix
+
+
+def mantid_available():
+    try:
+        import mantid.simpleapi #pylint: disable=unused-variable
+        return True
+    except ImportError:
+        return False
+
+
+def _mantid_peaks(run_number, direct_beam, x_min=50):
+    """ Find peaks with Mantid, as in plot_utils.process_run() """
+    from mantid.simpleapi import LoadEventNexus, RefRoi, Transpose, CropWorkspace, LRPeakSelection
+
+    ws = LoadEventNexus(Filename="REF_M%s" % run_number, NXentryName="entry-Off_Off",
+                        OutputWorkspace="%s_%s" % ("REF_M", run_number))
+    dirpix = ws.getRun()['DIRPIX'].value[0]
+    x_max = 250 if direct_beam else dirpix - 30
+
+    roi = RefRoi(InputWorkspace=ws, NXPixel=304, NYPixel=256, XPixelMin=50, XPixelMax=303,
+                 YPixelMin=0, YPixelMax=255, IntegrateY=True, ConvertToQ=False)
+    peaks = CropWorkspace(InputWorkspace=Transpose(InputWorkspace=roi), XMin=x_min, XMax=x_max)
+    output = LRPeakSelection(InputWorkspace=peaks)
+    x_peak = (output[0][0] + x_min, output[0][1] + x_min)
+
+    roi = RefRoi(InputWorkspace=ws, NXPixel=304, NYPixel=256, XPixelMin=0, XPixelMax=303,
+                 YPixelMin=0, YPixelMax=255, IntegrateY=False, ConvertToQ=False)
+    peaks = CropWorkspace(InputWorkspace=Transpose(InputWorkspace=roi), XMin=0, XMax=250)
+    output = LRPeakSelection(InputWorkspace=peaks)
+    return x_peak, tuple(output[1])
+
+
+def _init_worker(loader):
+    global _LOADER
+    _LOADER = loader
+
+
+def _find_run_peaks(task):
+    """
+        Find the peaks of a run.
+        @param task: (run number, direct beam flag)
+        @return: run number, direct beam flag, x peak, y peak, error message
+    """
+    run_number, direct_beam = task
+    try:
+        if _LOADER is None:
+            x_peak, y_peak = _mantid_peaks(run_number, direct_beam)
+        else:
+            counts, dirpix = _LOADER(run_number)
+            x_max = 250 if direct_beam else int(dirpix - 30)
+            x_peak, y_peak = find_peaks_array(counts, x_max=x_max)
+        return run_number, direct_beam, x_peak, y_peak, None
+    except Exception as error: #pylint: disable=broad-except
+        return run_number, direct_beam, None, None, str(error)
+
+
+class PeakCheck(object):
+    """ Input and found ranges for one run of a reduced file """
+    columns = ['file', 'run', 'type', 'peak_input', 'peak_found', 'low_res_input', 'low_res_found', 'status']
+
+    def __init__(self, file_path, run_settings, direct_beam):
+        self.file_path = file_path
+        self.run_number = run_settings['number']
+        self.direct_beam = direct_beam
+        self.peak_input = (run_settings['x_pos'] - run_settings['x_width'] / 2.0,
+                           run_settings['x_pos'] + run_settings['x_width'] / 2.0)
+        self.low_res_input = (run_settings['y_pos'] - run_settings['y_width'] / 2.0,
+                              run_settings['y_pos'] + run_settings['y_width'] / 2.0)
+        self.peak_found = None
+        self.low_res_found = None
+        self.error = None
+
+    def status(self, tolerance=2):
+        """ OK if the found ranges are within the input ranges, give or take tolerance pixels """
+        if self.error is not None:
+            return 'ERROR: %s' % self.error
+        if self.peak_found is None:
+            return 'MISSING'
+        for found, used in [(self.peak_found, self.peak_input), (self.low_res_found, self.low_res_input)]:
+            if found[0] < used[0] - tolerance or found[1] > used[1] + tolerance:
+                return 'CHECK'
+        return 'OK'
+
+    def row(self, tolerance=2):
+        def _range(values):
+            return '' if values is None else '%g-%g' % tuple(values)
+        return [self.file_path, self.run_number, 'direct' if self.direct_beam else 'data',
+                _range(self.peak_input), _range(self.peak_found),
+                _range(self.low_res_input), _range(self.low_res_found), self.status(tolerance)]
+
+
+def check_runs(top_dirs, data_dir=None, processes=None, loader=None, patterns=('*.dat', '*.txt')):
+    """
+        Compare the peak ranges used for the reduction to the ranges found in the data.
+
+        @param top_dirs: directories of reduced files
+        @param data_dir: directory of the Nexus files, used when Mantid is not available
+        @param processes: number of worker processes, or None for all the CPUs
+        @param loader: function returning ([304, 256] counts, DIRPIX) for a run number.
+                       By default, Mantid is used if available, otherwise load_detector().
+        @return: list of PeakCheck, in file order
+    """
+    if loader is None and not mantid_available():
+        if data_dir is None:
+            raise ValueError("Mantid is not available: the Nexus data directory is needed")
+        loader = functools.partial(load_detector, data_dir=data_dir)
+
+    checks = []
+    tasks = []
+    seen = set()
+    for file_path, settings in scan_settings(top_dirs, patterns=patterns):
+        for direct_beam, key in [(True, 'direct_beam_runs'), (False, 'data_runs')]:
+            for run_settings in settings[key]:
+                check = PeakCheck(file_path, run_settings, direct_beam)
+                checks.append(check)
+                if (check.run_number, direct_beam) not in seen:
+                    seen.add((check.run_number, direct_beam))
+                    tasks.append((check.run_number, direct_beam))
+    logging.info("Found %s runs in %s entries", len(tasks), len(checks))
+
+    t0 = time.time()
+    if processes == 1:
+        _init_worker(loader)
+        results = map(_find_run_peaks, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(loader,))
+        results = pool.imap_unordered(_find_run_peaks, tasks)
+
+    found = {}
+    for run_number, direct_beam, x_peak, y_peak, error in results:
+        found[(run_number, direct_beam)] = (x_peak, y_peak, error)
+
+    if processes != 1:
+        pool.close()
+        pool.join()
+    logging.info("Processed %s runs in %s sec", len(tasks), time.time() - t0)
+
+    for check in checks:
+        check.peak_found, check.low_res_found, check.error = found[(check.run_number, check.direct_beam)]
+    return checks
+
+
+def write_table(checks, output=None, tolerance=2):
+    """ Print the table of checks, and optionally write it to a CSV file """
+    printout = "%-6s %-7s %-14s %-14s %-14s %-14s %s\n" % ('Run', 'Type', 'Peak input', 'Peak found',
+                                                         'Low-res input', 'Low-res found', 'Status')
+    for check in checks:
+        row = check.row(tolerance)
+        printout += "%-6s %-7s %-14s %-14s %-14s %-14s %s\n" % tuple(row[1:])
+    print(printout)
+
+    if output is not None:
+        with open(output, 'w') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(PeakCheck.columns)
+            for check in checks:
+                writer.writerow(check.row(tolerance))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the peak ranges of reduced runs to the data')
+    parser.add_argument('top_dirs', nargs='+', help='directories of reduced files')
+    parser.add_argument('-d', metavar='data_dir', help='directory of the Nexus files, when Mantid is not available',
+                        dest='data_dir', default=None)
+    parser.add_argument('-o', metavar='output_name', help='CSV file to write the table to',
+                        dest='output_name', default=None)
+    parser.add_argument('-j', metavar='processes', type=int, help='number of processes',
+                        dest='processes', default=None)
+    parser.add_argument('-t', metavar='tolerance', type=float, help='tolerance on the ranges, in pixels',
+                        dest='tolerance', default=2)
+    namespace = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    _checks = check_runs(namespace.top_dirs, data_dir=namespace.data_dir, processes=namespace.processes)
+    write_table(_checks, output=namespace.output_name, tolerance=namespace.tolerance)
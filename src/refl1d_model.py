@@ -1,6 +1,10 @@
 #pylint: disable=missing-docstring, line-too-long, too-many-instance-attributes, invalid-name, too-few-public-methods, exec-used, no-self-use, too-many-statements, too-many-locals
 """
     Process chains from a refl1d output population and extract statistics
+
+    The parsing classes only need numpy and the standard library. refl1d and
+    bumps are imported when profiles are built or chains are loaded, so that
+    parsing and summarizing .err files stays fast.
 """
 from __future__ import absolute_import, division, print_function
 import logging
@@ -11,12 +15,6 @@ import argparse
 import os
 import numpy as np
 from collections import OrderedDict
-from refl1d.names import *
-from refl1d.probe import make_probe
-from refl1d.rebin import rebin
-from bumps import dream
-from refl1d.errors import calc_errors
-from bumps.cli import load_model
 
 def parse_single_param(line):
     """
@@ -118,8 +116,10 @@ class ReflectivityModel(object):
             materials += "%s\n" % layer_obj.material()
             slabs.append(layer_obj.layer())
         sample = "sample = (%s)" % '\n    | '.join(slabs)
-        exec "%s\n%s" % (materials, sample)
-        return sample
+        from refl1d import names
+        namespace = dict(vars(names))
+        exec("%s\n%s" % (materials, sample), namespace)
+        return namespace['sample']
 
     def __repr__(self):
         """ Pretty print this model """
@@ -159,9 +159,10 @@ class ReflectivityProblem(object):
         self.file_path = file_path
         self.model_list = []
         self.fit_params = []
+        self.chi2 = 0
 
         with open('%s.err' % file_path, 'r') as fd:
-            self.model_list, _, self.fit_params = self.parse_slabs(fd.read())
+            self.model_list, self.chi2, self.fit_params = self.parse_slabs(fd.read())
 
     def parse_slabs(self, content):
         """
@@ -307,6 +308,9 @@ class ReflectivityProblem(object):
 
     def convert_to_model(self):
         """ Convert this model into a refl1d model """
+        from refl1d.names import Experiment, PolarizedNeutronProbe
+        from refl1d.probe import make_probe
+
         sld_profiles = []
         for name, m in self.model_list.items():
             sample = m.convert_to_refl1d()
@@ -322,20 +326,25 @@ class ReflectivityProblem(object):
 
         return sld_profiles
 
-    def load_bumps(self):
+    def load_bumps(self, keep_draws=False):
         """
             Use bumps to load MC
 
             Example: to histogram first parameter: hist(draw.points[:, 0])
 
             We can use draw() instead of sample() [deprecated]
+
+            @param keep_draws: if True, the accumulators keep each rebinned profile
         """
+        # bumps.dream does not import its state module by itself
+        from bumps.dream.state import load_state
+
         acc = {}
         for name, m in self.model_list.items():
-            acc[name] = Accumulator(name)
+            acc[name] = Accumulator(name, keep_draws=keep_draws)
 
         t0 = time.time()
-        state = dream.state.load_state(self.file_path)
+        state = load_state(self.file_path)
         state.mark_outliers()
 
         drawn = state.draw()
@@ -373,7 +382,7 @@ class ReflectivityProblem(object):
         return printout
 
 class Accumulator(object):
-    def __init__(self, name='', z_min=-10, z_max=450, z_step=5.0):
+    def __init__(self, name='', z_min=-10, z_max=450, z_step=5.0, keep_draws=False):
         self.z = np.arange(z_min, z_max, z_step)
         self.summed = np.zeros(len(self.z)-1)
         self.sq_summed = np.zeros(len(self.z)-1)
@@ -382,24 +391,38 @@ class Accumulator(object):
         self.counts = np.zeros(len(self.z)-1)
         self.z_step = z_step
         self.name = name
+        self.keep_draws = keep_draws
+        self.draws = []
+        self.m_draws = []
 
     def add(self, z, rho, rhoM):
-        """ Add a model to the average """
-        z_ = np.asarray([z[i] for i in range(0, len(z), 2)])
-        rho_ = np.asarray([rho[i+1] for i in range(0, len(rho)-2, 2)])
-        r_out = rebin(z_, rho_, self.z)
-        rhoM_ = np.asarray([rhoM[i+1] for i in range(0, len(rhoM)-2, 2)])
-        rM_out = rebin(z_, rhoM_, self.z)
-
-        # Compute the average step size so we can normalize after rebinning
-        average_step = np.asarray([z[i+1]-z[i] for i in range(0, len(z)-2, 2) if z[i]>0]).mean()
-        r_out = r_out * average_step / self.z_step
-        rM_out = rM_out * average_step / self.z_step
+        """
+            Add a model to the average.
+            Bin boundaries are at even indices and values at odd indices.
+        """
+        try:
+            from refl1d.rebin import rebin
+        except ImportError:
+            # Newer versions of refl1d
+            from refl1d.probe.data_loaders.rebin import rebin
+
+        z_ = np.asarray(z[0::2])
+        rho_ = np.asarray(rho[1:len(rho)-1:2])
+        rhoM_ = np.asarray(rhoM[1:len(rhoM)-1:2])
+
+        # rebin() works on integrated values: weight each bin by its width
+        # so that bins of different widths can be combined
+        widths = np.diff(z_)
+        r_out = rebin(z_, rho_ * widths, self.z) / self.z_step
+        rM_out = rebin(z_, rhoM_ * widths, self.z) / self.z_step
 
         self.summed += r_out
         self.sq_summed += r_out * r_out
         self.m_summed += rM_out
         self.m_sq_summed += rM_out * rM_out
+        if self.keep_draws:
+            self.draws.append(r_out)
+            self.m_draws.append(rM_out)
         _counts = [ 1*(z>z_[0] and z<z_[-1]) for z in self.z[:-1] ]
         self.counts += _counts
 
@@ -419,15 +442,40 @@ class Accumulator(object):
 
         return avg, sig
 
-def process(filepath, output):
+    def get_draws(self):
+        """ Return the individual rebinned profiles, if they were kept """
+        if not self.draws:
+            return None, None
+        return np.asarray(self.draws), np.asarray(self.m_draws)
+
+def summary(filepath):
+    """
+        Print a summary of a fit from its .err file.
+        This only parses the log and does not need refl1d or bumps.
+    """
+    model = ReflectivityProblem(filepath)
+    print("Overall chi2: %s" % model.chi2)
+    print(model)
+
+def process(filepath, output, keep_draws=False):
     """
-        Process a model output
+        Process a model output.
+        If the output file has a .npz extension, the results are written
+        to a single binary result file (see result_store.py). Otherwise,
+        one text file is written per model.
     """
     model = ReflectivityProblem(filepath)
     print(model)
     print("Number of fit pars: %s" % len(model.fit_params))
 
-    statistics = model.load_bumps()
+    binary_output = output.endswith('.npz')
+    statistics = model.load_bumps(keep_draws=binary_output)
+
+    if binary_output:
+        from result_store import save_results
+        save_results(output, statistics, model.fit_params, keep_draws=keep_draws)
+        return
+
     for s in statistics.keys():
         avg, sig = statistics[s].mean()
         avg_m, sig_m = statistics[s].mean_magnetism()
@@ -446,6 +494,10 @@ if __name__ == "__main__":
         python refl1d_model.py -o model152both_stats.txt -m /SNS/REF_M/IPTS-19586/shared/fiting/MGN152Both_3/model152both
 
         python refl1d_model.py -o test_stats.txt -m /SNS/users/m2d/git/refl1d_analysis/playground/matfit/model152both
+
+        python refl1d_model.py -o model152both_stats.npz --keep-draws -m /SNS/REF_M/IPTS-19586/shared/fiting/MGN152Both_3/model152both
+
+        python refl1d_model.py --summary -m /SNS/REF_M/IPTS-19586/shared/fiting/MGN152Both_3/model152both
     """
     # Start/restart options
     parser = argparse.ArgumentParser(add_help=False)
@@ -453,14 +505,27 @@ if __name__ == "__main__":
     # Name of the output file
     parser.add_argument('-o', metavar='output_name',
                         help='name of the output file',
-                        dest='output_name', required=True)
+                        dest='output_name', default=None)
 
     # Location of the model to processe
     parser.add_argument('-m', metavar='hours',
                         help='location of the model',
                         dest='model_path', required=True)
 
+    # Keep individual profiles (only for .npz output)
+    parser.add_argument('--keep-draws', help='store the profile of each draw in the .npz output',
+                        dest='keep_draws', action='store_true', default=False)
+
+    # Only print a summary of the fit, without processing the MC chains
+    parser.add_argument('-s', '--summary', help='print a summary of the fit and exit',
+                        dest='summary', action='store_true', default=False)
+
     namespace = parser.parse_args()
 
-    process(namespace.model_path, namespace.output_name)
+    if namespace.summary:
+        summary(namespace.model_path)
+    elif namespace.output_name is None:
+        parser.error("an output file (-o) is needed to process a model")
+    else:
+        process(namespace.model_path, namespace.output_name, keep_draws=namespace.keep_draws)
 
@@ -0,0 +1,178 @@
+#pylint: disable=missing-docstring, invalid-name, too-many-locals
+"""
+    Binary store for processed fit results.
+
+    A result file is a compressed numpy archive (.npz) holding, for each model,
+    the z-grid, the mean and standard deviation of the SLD and magnetic SLD,
+    their quantiles, and optionally the individual rebinned profiles of each
+    MC draw. The fit parameters parsed from the .err file are stored alongside
+    so that results can be re-plotted or re-banded without reprocessing the chains.
+
+    Per-draw profiles are split into chunks of `chunk_size` draws. Each chunk
+    is a separate compressed member of the archive and is only decompressed
+    when it is accessed.
+
+    Layout of the archive:
+
+        models                      names of the models
+        fit_params/names            parameter names
+        fit_params/values           best values
+        fit_params/errors           uncertainties
+        <model>/z                   bin edges of the z-grid
+        <model>/rho_mean            mean SLD for each bin
+        <model>/rho_sigma           standard deviation of the SLD
+        <model>/rhoM_mean           mean magnetic SLD
+        <model>/rhoM_sigma          standard deviation of the magnetic SLD
+        <model>/quantile_levels     levels at which quantiles are computed
+        <model>/rho_quantiles       [n_levels, n_bins] SLD quantiles
+        <model>/rhoM_quantiles      [n_levels, n_bins] magnetic SLD quantiles
+        <model>/draws/rho_<i>       i-th chunk of per-draw SLD profiles
+        <model>/draws/rhoM_<i>      i-th chunk of per-draw magnetic SLD profiles
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+QUANTILE_LEVELS = (0.025, 0.16, 0.5, 0.84, 0.975)
+FORMAT_VERSION = 1
+
+
+def save_results(output, statistics, fit_params=None, keep_draws=False,
+                 chunk_size=250, quantile_levels=QUANTILE_LEVELS):
+    """
+        Write processed results to a compressed .npz file.
+
+        @param output: name of the output file
+        @param statistics: dictionary of Accumulator objects, keyed by model name
+        @param fit_params: list of [name, value, error] as returned by parse_single_param
+        @param keep_draws: if True, store the per-draw profiles
+        @param chunk_size: number of draws per stored chunk
+        @param quantile_levels: quantile levels to compute, if draws are available
+    """
+    arrays = dict(format_version=np.asarray(FORMAT_VERSION))
+    names = [str(s) for s in statistics.keys()]
+    arrays['models'] = np.asarray(names)
+
+    if fit_params is None:
+        fit_params = []
+    arrays['fit_params/names'] = np.asarray([str(p[0]) for p in fit_params])
+    arrays['fit_params/values'] = np.asarray([np.nan if p[1] is None else p[1] for p in fit_params], dtype=float)
+    arrays['fit_params/errors'] = np.asarray([np.nan if p[2] is None else p[2] for p in fit_params], dtype=float)
+
+    for name in names:
+        acc = statistics[name]
+        avg, sig = acc.mean()
+        avg_m, sig_m = acc.mean_magnetism()
+        arrays['%s/z' % name] = np.asarray(acc.z)
+        arrays['%s/rho_mean' % name] = avg
+        arrays['%s/rho_sigma' % name] = sig
+        arrays['%s/rhoM_mean' % name] = avg_m
+        arrays['%s/rhoM_sigma' % name] = sig_m
+
+        rho_draws, rhoM_draws = acc.get_draws()
+        if rho_draws is None:
+            continue
+
+        arrays['%s/quantile_levels' % name] = np.asarray(quantile_levels, dtype=float)
+        arrays['%s/rho_quantiles' % name] = np.quantile(rho_draws, quantile_levels, axis=0)
+        arrays['%s/rhoM_quantiles' % name] = np.quantile(rhoM_draws, quantile_levels, axis=0)
+
+        if keep_draws:
+            for i, start in enumerate(range(0, len(rho_draws), chunk_size)):
+                arrays['%s/draws/rho_%04d' % (name, i)] = rho_draws[start:start+chunk_size]
+                arrays['%s/draws/rhoM_%04d' % (name, i)] = rhoM_draws[start:start+chunk_size]
+
+    with open(output, 'wb') as fd:
+        np.savez_compressed(fd, **arrays)
+
+
+class ModelResult(object):
+    """ Stored results for a single model """
+    def __init__(self, name, archive):
+        self.name = name
+        self._archive = archive
+        self.z = archive['%s/z' % name]
+        self.rho_mean = archive['%s/rho_mean' % name]
+        self.rho_sigma = archive['%s/rho_sigma' % name]
+        self.rhoM_mean = archive['%s/rhoM_mean' % name]
+        self.rhoM_sigma = archive['%s/rhoM_sigma' % name]
+
+        self.quantile_levels = None
+        self.rho_quantiles = None
+        self.rhoM_quantiles = None
+        if '%s/quantile_levels' % name in archive.files:
+            self.quantile_levels = archive['%s/quantile_levels' % name]
+            self.rho_quantiles = archive['%s/rho_quantiles' % name]
+            self.rhoM_quantiles = archive['%s/rhoM_quantiles' % name]
+
+        prefix = '%s/draws/rho_' % name
+        self.n_chunks = len([f for f in archive.files if f.startswith(prefix)])
+
+    def draw_chunks(self, magnetic=False):
+        """ Iterate over the stored chunks of per-draw profiles """
+        key = 'rhoM' if magnetic else 'rho'
+        for i in range(self.n_chunks):
+            yield self._archive['%s/draws/%s_%04d' % (self.name, key, i)]
+
+    def draws(self, magnetic=False):
+        """ Return all the stored per-draw profiles as a single array """
+        if self.n_chunks == 0:
+            return None
+        return np.concatenate(list(self.draw_chunks(magnetic=magnetic)))
+
+    def band(self, lower=0.16, upper=0.84, magnetic=False):
+        """
+            Return the [lower, upper] quantile band.
+            Stored quantiles are used when available, otherwise they are
+            computed from the per-draw profiles.
+        """
+        quantiles = self.rhoM_quantiles if magnetic else self.rho_quantiles
+        if quantiles is not None:
+            levels = list(self.quantile_levels)
+            if lower in levels and upper in levels:
+                return quantiles[levels.index(lower)], quantiles[levels.index(upper)]
+
+        draws = self.draws(magnetic=magnetic)
+        if draws is None:
+            raise RuntimeError("No quantiles or draws stored for %s" % self.name)
+        return np.quantile(draws, lower, axis=0), np.quantile(draws, upper, axis=0)
+
+
+class ResultStore(object):
+    """
+        Read access to a result file written by save_results().
+        Arrays are only read from disk when they are accessed.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._archive = np.load(file_path)
+        self.model_names = [str(n) for n in self._archive['models']]
+        self.fit_params = [[str(n), v, e] for n, v, e in zip(self._archive['fit_params/names'],
+                                                              self._archive['fit_params/values'],
+                                                              self._archive['fit_params/errors'])]
+        self.models = dict((name, ModelResult(name, self._archive)) for name in self.model_names)
+
+    def close(self):
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.models[name]
+
+    def __repr__(self):
+        printout = "Results: %s\n" % self.file_path
+        for name in self.model_names:
+            printout += "   %15s\t %s bins, %s draw chunks\n" % (name, len(self.models[name].rho_mean),
+                                                              self.models[name].n_chunks)
+        for i, item in enumerate(self.fit_params):
+            printout += "%s- %s\n" % (i, str(item))
+        return printout
+
+
+def load_results(file_path):
+    """ Open a result file written by save_results() """
+    return ResultStore(file_path)
@@ -0,0 +1,32 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+import pytest
+from batch_abeles import reflectivity, random_stacks, validate
+
+def test_fresnel():
+    """ A single bare interface is given by the Fresnel formula """
+    q = np.linspace(0.005, 0.2, 200)
+    kz = q / 2.0
+    r = reflectivity(kz, [0, 0], [0, 2.07], irho=0, sigma=0)
+
+    kz_sub = np.sqrt(kz**2 - 4e-6 * np.pi * 2.07 + 0j)
+    fresnel = np.abs((kz - kz_sub) / (kz + kz_sub))**2
+    assert np.allclose(r, fresnel)
+    assert np.allclose(r[q < 0.0102], 1.0)
+
+def test_batch_matches_single():
+    q = np.linspace(-0.1, 0.1, 101)
+    depth, rho, irho, sigma = random_stacks(5, 6, seed=1)
+    batch = reflectivity(q / 2.0, depth, rho, irho=irho, sigma=sigma)
+    assert batch.shape == (5, 101)
+    for i in range(5):
+        single = reflectivity(q / 2.0, depth[i], rho[i], irho=irho[i], sigma=sigma[i])
+        assert np.allclose(batch[i], single)
+
+def test_refl1d():
+    pytest.importorskip('refl1d')
+    q = np.linspace(0.008, 0.2, 300)
+    _, ok = validate(q / 2.0, *random_stacks(20, 8, seed=2))
+    assert ok
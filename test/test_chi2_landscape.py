@@ -0,0 +1,36 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+import pytest
+
+pytest.importorskip('refl1d')
+
+from chi2_landscape import compute_landscape, Landscape
+
+MODEL = '../data/207296_model.py'
+
+
+def test_landscape(tmpdir):
+    values = np.linspace(3.5, 4.2, 3)
+    landscape = compute_landscape(MODEL, [('SEI rho', values)], processes=1)
+    assert landscape.chi2.shape == (3,)
+    assert np.all(np.isfinite(landscape.chi2))
+    assert np.allclose(landscape.parameters[:, landscape.labels.index('SEI rho')], values)
+    best, _ = landscape.best()
+    assert best[0] in values
+
+    output = str(tmpdir.join('landscape.npz'))
+    landscape.save(output)
+    loaded = Landscape.load(output)
+    assert loaded.labels == landscape.labels
+    assert loaded.names == ['SEI rho']
+    assert np.allclose(loaded.axes[0], values)
+    assert np.allclose(loaded.chi2, landscape.chi2)
+    assert np.allclose(loaded.parameters, landscape.parameters)
+    assert loaded.optimized is False
+
+
+def test_unknown_parameter():
+    with pytest.raises(ValueError):
+        compute_landscape(MODEL, [('not a parameter', [1.0])], processes=1)
@@ -0,0 +1,106 @@
+import os
+import shutil
+import sqlite3
+import sys
+sys.path.append('../src')
+
+from fit_index import FitIndex, parse_constraint
+
+
+def _single_model(tmpdir, name, magnetic=False):
+    """
+        Write a single-model .err file made of the first model of model152both
+        and its parameter table, without the model names
+    """
+    with open('data/model152both.err') as fd:
+        lines = fd.read().splitlines(True)
+    end = [i for i, l in enumerate(lines) if l.startswith('[chisq=')][0]
+    table = [l for l in lines[end:] if l[:3].strip().isdigit()]
+    pars = [l for l in table if 'T300' not in l and 'T050' not in l]
+    if magnetic:
+        pars = [l.replace('T300 ', '') for l in table if 'T300' in l] + pars
+    tmpdir.join(name).write(''.join(lines[:end+1] + pars))
+
+
+def test_parse_constraint():
+    assert parse_constraint("Cu thickness>500") == ('Cu thickness', '>', 500.0)
+    assert parse_constraint("MGN_1 rho <= 1e-1") == ('MGN_1 rho', '<=', 0.1)
+
+def test_index(tmpdir):
+    fit_dir = tmpdir.mkdir('IPTS-19586').mkdir('MGN152Both_3')
+    shutil.copy('data/model152both.err', str(fit_dir))
+    db_path = str(tmpdir.join('fits.db'))
+
+    with FitIndex(db_path) as fit_index:
+        assert fit_index.update(str(tmpdir)) == (1, 0, 0, [])
+        assert fit_index.update(str(tmpdir)) == (0, 1, 0, [])
+
+        results = fit_index.query(["MGN_1 thickness>175"], chi2_max=50)
+        assert len(results) == 1
+        assert results[0][1] == 49.28
+        assert fit_index.query(["MGN_1 thickness>175"], chi2_max=2) == []
+        assert fit_index.query(["T300 MGN_1 rhoM<0.1"]) == []
+
+        # Underscores and case are matched literally
+        assert len(fit_index.query(["MGN_1 rhoM>0.1"])) == 1
+        assert fit_index.query(["MGNx1 rhoM>0.1"]) == []
+        assert fit_index.query(["mgn_1 rhoM>0.1"]) == []
+        assert fit_index.query(["GN_1 rhoM>0.1"]) == []
+
+        pars = fit_index.parameters(os.path.join(str(fit_dir), 'model152both.err'))
+        assert len(pars) == 24
+        assert pars[0][0] == 'T300 MGN_1 interfaceM above'
+
+        os.remove(os.path.join(str(fit_dir), 'model152both.err'))
+        assert fit_index.update(str(tmpdir)) == (0, 0, 1, [])
+        assert fit_index.query() == []
+
+def test_single_model(tmpdir):
+    fit_dir = tmpdir.mkdir('fits')
+    _single_model(fit_dir, 'single.err')
+    fit_dir.join('no_chi2.err').write(fit_dir.join('single.err').read().replace('[chisq=21.162(86)', '[chisq=(86)'))
+
+    with FitIndex(str(tmpdir.join('fits.db'))) as fit_index:
+        assert fit_index.update(str(fit_dir)) == (2, 0, 0, [])
+        results = dict(fit_index.query(["MGN_1 thickness>175"]))
+        assert results[str(fit_dir.join('single.err'))] == 21.162
+        assert results[str(fit_dir.join('no_chi2.err'))] is None
+        assert fit_index.query(chi2_max=2) == []
+        assert len(fit_index.query(chi2_max=25)) == 1
+
+
+def test_failures(tmpdir):
+    fit_dir = tmpdir.mkdir('fits')
+    _single_model(fit_dir, 'single.err')
+    # Parameter names with three tokens are mistaken for model names
+    _single_model(fit_dir, 'magnetic.err', magnetic=True)
+    failed_path = str(fit_dir.join('magnetic.err'))
+    db_path = str(tmpdir.join('fits.db'))
+
+    with FitIndex(db_path) as fit_index:
+        assert fit_index.update(str(fit_dir)) == (1, 0, 0, [failed_path])
+        assert fit_index.update(str(fit_dir)) == (0, 2, 0, [])
+        failures = fit_index.failures()
+        assert len(failures) == 1
+        assert failures[0][0] == failed_path
+        assert failures[0][1].startswith('IndexError')
+        assert [r[0] for r in fit_index.query()] == [str(fit_dir.join('single.err'))]
+
+        # A modified file is parsed again
+        fit_dir.join('magnetic.err').write(fit_dir.join('single.err').read())
+        assert fit_index.update(str(fit_dir)) == (1, 1, 0, [])
+        assert fit_index.failures() == []
+
+
+def test_old_schema(tmpdir):
+    db_path = str(tmpdir.join('fits.db'))
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE fits (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,"
+                       " mtime REAL NOT NULL, size INTEGER NOT NULL, chi2 REAL)")
+    connection.close()
+
+    fit_dir = tmpdir.mkdir('fits')
+    _single_model(fit_dir, 'magnetic.err', magnetic=True)
+    with FitIndex(db_path) as fit_index:
+        assert len(fit_index.update(str(fit_dir))[3]) == 1
+        assert len(fit_index.failures()) == 1
@@ -0,0 +1,62 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+import pytest
+from batch_abeles import reflectivity
+from microslice import slab_profile, adaptive_slices, SliceResult
+
+def test_error_bound():
+    # Rough gold layer from the absorption notebook
+    depth = [0, 10.0, 850, 60, 4.94, 0]
+    rho = [6.05, 4.0, 4.264, 2.8, 3.025, 2.067]
+    irho = [0, 0, 0.1, 0, 0, 0]
+    sigma = [4.963, 1.017, 105.5, 1.6, 2.0]
+    z, rho_z, irho_z = slab_profile(depth, rho, irho, sigma, dz=0.25)
+
+    q = np.logspace(np.log10(0.008), np.log10(0.1), 100)
+    result = adaptive_slices(z, rho_z, irho_z, tolerance=1e-3, q_min=q[0], dz=2.0)
+    assert result.error_bound <= 1e-3
+    assert result.saved > result.n_fixed / 2
+    assert np.isclose(np.sum(result.depth), len(z) * 0.25)
+
+    media = [(rho[0], irho[0]), (rho[-1], irho[-1])]
+    fine = SliceResult(np.full(len(z), 0.25), rho_z, irho_z, len(z), len(z), 0, 0, q[0])
+    r_fine = np.sqrt(reflectivity(q / 2.0, *fine.stack(*media)))
+    r_adaptive = np.sqrt(reflectivity(q / 2.0, *result.stack(*media)))
+    assert np.max(np.abs(r_adaptive - r_fine)) <= result.error_bound
+
+def test_flat_profile():
+    z = np.arange(0, 100, 0.5)
+    result = adaptive_slices(z, np.full(len(z), 2.07))
+    assert result.n_slabs == 1
+    assert result.error_bound == 0
+
+def test_profile():
+    z = np.arange(0, 100, 0.5)
+    rho = np.where(z < 50, 2.07, 6.2)
+    result = adaptive_slices(z, rho, rhoM=np.where(z < 30, 1.0, 0.0))
+    assert result.n_slabs == 3
+    z_p, rho_p, _, rhoM_p = result.profile()
+    assert np.isclose(z_p[0], -0.25) and np.isclose(z_p[-1], 99.75)
+    assert np.allclose(rho_p[1::2], [2.07, 2.07, 6.2])
+    # Slabs keep the mean of what they replace
+    assert np.isclose(np.sum(rhoM_p[1::2] * result.depth), 30.0)
+
+def test_slice_experiment():
+    pytest.importorskip('refl1d')
+    from refl1d.names import SLD, Experiment, QProbe
+    from microslice import slice_experiment
+
+    q = np.logspace(np.log10(0.008), np.log10(0.1), 100)
+    sample = SLD('Si', rho=2.07)(0, 3) | SLD('Au', rho=4.5, irho=0.1)(850, 105.5) | SLD('D2O', rho=6.2)(0, 5)
+    expt = Experiment(sample=sample, probe=QProbe(q, 0 * q), dz=0.5, step_interfaces=True)
+    _, r_expt = expt.reflectivity()
+
+    result = slice_experiment(expt, tolerance=1e-3)
+    assert result.saved > result.n_fixed / 2
+    r_adaptive = reflectivity(q / 2.0, *result.stack((6.2, 0), (2.07, 0)))
+    assert np.max(np.abs(np.sqrt(r_adaptive) - np.sqrt(r_expt))) <= result.error_bound
+
+    with pytest.raises(ValueError):
+        slice_experiment(Experiment(sample=sample, probe=QProbe(q, 0 * q)))
@@ -0,0 +1,72 @@
+import json
+import sys
+sys.path.append('../src')
+
+import numpy as np
+import pytest
+from model_json import ModelBridge, compact_model, expand_model, apply_patch, make_patch, from_refl1d
+
+def load_model():
+    with open('../data/207296_model.json', 'r') as fd:
+        return json.load(fd)
+
+def test_compact_round_trip():
+    model = load_model()
+    compact = compact_model(model, keep_ids=True)
+    thickness = compact['models'][0]['sample']['layers'][1]['thickness']
+    assert 'slot' not in thickness and 'type' not in thickness
+    assert thickness['value'] == 177.7
+    assert expand_model(compact) == model
+
+def test_patch():
+    doc = {'layers': [{'name': 'Si', 'rho': {'value': 2.07}}, {'name': 'THF', 'rho': {'value': 6.13}}]}
+    patched = apply_patch(doc, [{'op': 'replace', 'path': '/layers/1/rho/value', 'value': 6.3},
+                                {'op': 'move', 'from': '/layers/0', 'path': '/layers/-'}])
+    assert [l['name'] for l in patched['layers']] == ['THF', 'Si']
+    assert patched['layers'][0]['rho']['value'] == 6.3
+    # The original is untouched and unchanged sub-trees are shared
+    assert doc['layers'][1]['rho']['value'] == 6.13
+    assert patched['layers'][1] is doc['layers'][0]
+    assert apply_patch(doc, make_patch(doc, patched)) == patched
+
+def test_bridge():
+    bridge = ModelBridge(load_model())
+    version, text = bridge.export()
+    path = '/models/0/sample/layers/3/thickness/value'
+    new_version, new_text = bridge.apply([{'op': 'replace', 'path': path, 'value': 600.0}])
+    assert new_version != version
+    assert json.loads(new_text)['models'][0]['sample']['layers'][3]['thickness']['value'] == 600.0
+    assert json.loads(new_text) == json.loads(json.dumps(bridge.doc))
+    assert bridge.get(version) == text
+    assert bridge.diff(version) == [{'op': 'replace', 'path': path, 'value': 600.0}]
+    # Going back to the same content gives back the same version
+    assert bridge.apply([{'op': 'replace', 'path': path, 'value': 566.1}])[0] == version
+
+def test_shared_parameters():
+    par = {'id': 'p1', 'name': 'rho', 'fixed': True, 'slot': {'value': 2.07, '__class__': 'bumps.parameter.Variable'},
+           'limits': ['-inf', 'inf'], 'bounds': None, 'distribution': {'__class__': 'bumps.parameter.Uniform'},
+           'discrete': False, 'tags': [], '__class__': 'bumps.parameter.Parameter'}
+    ref = {'id': 'p1', '__class__': 'Reference'}
+    doc = {'$schema': 'bumps-draft-03', 'object': {'a': ref, 'b': dict(ref), 'slot': {'value': 1}},
+           'references': {'p1': par}}
+    compact = compact_model(doc)
+    assert compact['references'] == {}
+    assert compact['object']['a']['__class__'] == 'Parameter'
+    # Shared parameters keep their id
+    assert compact['object']['a']['id'] == 'p1'
+    assert expand_model(compact) == doc
+
+def test_refl1d_round_trip():
+    pytest.importorskip('refl1d')
+    from chi2_landscape import load_problem
+    problem = load_problem('../data/207296_model.py')
+    bridge = ModelBridge(from_refl1d(problem))
+    assert 'Reference' not in bridge.export()[1]
+    assert bridge.layers()[3]['thickness']['value'] == 566.1
+
+    new_problem = bridge.to_refl1d()
+    assert new_problem.labels() == problem.labels()
+    assert np.allclose(list(new_problem.models)[0].reflectivity()[1], list(problem.models)[0].reflectivity()[1])
+
+    bridge.apply([{'op': 'replace', 'path': '/object/models/0/sample/layers/3/thickness/value', 'value': 600.0}])
+    assert list(bridge.to_refl1d().models)[0].sample[3].thickness.value == 600.0
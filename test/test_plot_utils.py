@@ -0,0 +1,38 @@
+import sys
+sys.path.append('../notebooks')
+
+import numpy as np
+import pytest
+
+plot_utils = pytest.importorskip('plot_utils')
+
+def test_lttb():
+    x = np.linspace(0, 10, 10000)
+    y = np.sin(x)
+    y[1234] = 5
+    idx = plot_utils.lttb(x, y, 100)
+    assert len(idx) == 100
+    assert idx[0] == 0 and idx[-1] == len(x) - 1
+    assert np.all(np.diff(idx) > 0)
+    # Spikes are kept
+    assert 1234 in idx
+    assert len(plot_utils.lttb(x[:50], y[:50], 100)) == 50
+
+def test_decimate():
+    # Many short traces share the budget
+    traces = [[np.arange(100.0), np.random.rand(100), np.ones(100)] for _ in range(1000)]
+    output = plot_utils.decimate(traces, 20000)
+    assert sum([len(t[0]) for t in output]) <= 20000
+    assert all(len(t[2]) == len(t[0]) for t in output)
+    assert plot_utils.decimate(traces, None) is traces
+
+def test_block_reduce():
+    z = np.arange(12.0).reshape(3, 4)
+    x, y, reduced = plot_utils.block_reduce(np.arange(4), np.arange(3), z, max_shape=(2, 2))
+    assert reduced.shape == (2, 2)
+    assert np.allclose(reduced, [[2.5, 4.5], [8.5, 10.5]])
+    assert np.allclose(x, [0.5, 2.5]) and np.allclose(y, [0.5, 2])
+    # Bin edges are kept as edges
+    x, _, _ = plot_utils.block_reduce(np.arange(5), np.arange(3), z, max_shape=(2, 2))
+    assert np.allclose(x, [0, 2, 4])
+    assert plot_utils.block_reduce(np.arange(4), np.arange(3), z)[2] is z
@@ -0,0 +1,30 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+from posterior_stats import PosteriorStats
+
+def test_posterior_stats():
+    rng = np.random.RandomState(0)
+    points = rng.normal(size=(5000, 4))
+    points[:, 1] += 0.5 * points[:, 0]
+    logp = -0.5 * np.sum(points**2, axis=1)
+
+    stats = PosteriorStats(points, logp, labels=['a', 'b', 'c', 'd'])
+    # Process one column and 700 rows at a time
+    blocked = PosteriorStats(points, logp, max_memory=5000*6*8, row_chunk=700)
+
+    assert np.allclose(stats.correlation, np.corrcoef(points.T))
+    assert np.allclose(blocked.correlation, stats.correlation)
+    assert np.allclose(blocked.quantiles, stats.quantiles)
+    assert np.allclose(stats.quantiles, np.quantile(points, stats.quantile_levels, axis=0), atol=1e-2)
+    assert np.allclose(stats.best, points[np.argmax(logp)])
+
+    heights, _ = np.histogram(points[:, 2], bins=30, range=stats[2].p95_range)
+    assert np.allclose(stats.hist_heights[2], heights / 5000.0)
+
+def test_weights():
+    points = np.array([[1.0], [2.0], [3.0]])
+    stats = PosteriorStats(points, np.zeros(3), weights=[1, 0, 1])
+    assert np.isclose(stats.mean[0], 2.0)
+    assert np.isclose(stats.std[0], 1.0)
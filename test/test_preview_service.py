@@ -0,0 +1,83 @@
+import copy
+import json
+import sys
+import threading
+import time
+import pytest
+sys.path.append('../src')
+
+from preview_service import PreviewService, layer_stack
+
+def load_layers():
+    with open('../data/207296_model.json', 'r') as fd:
+        return json.load(fd)['models'][0]['sample']['layers']
+
+def test_layer_stack():
+    names, depth, rho, _, sigma = layer_stack(load_layers())
+    # The incident medium comes first, and each interface is the top of a layer
+    assert names == ['Si', 'Ti', 'Cu', 'material', 'SEI', 'THF']
+    assert depth[2] == 566.1
+    assert rho[0] == 2.07
+    assert list(sigma[:2]) == [12.7, 9.736]
+
+def test_memoization():
+    service = PreviewService(debounce=0)
+    n_computed = service.n_computed
+    layers = load_layers()
+    first = service.request(layers)
+    assert len(first['r']) == len(service.q)
+    assert service.request(copy.deepcopy(layers)) is first
+    assert service.n_computed == n_computed + 1
+
+def test_burst():
+    service = PreviewService(debounce=0.05)
+    n_computed = service.n_computed
+    layers = load_layers()
+    results = []
+
+    def edit(value):
+        _layers = copy.deepcopy(layers)
+        _layers[1]['thickness']['slot']['value'] = value
+        results.append(service.request(_layers, client='builder'))
+
+    threads = [threading.Thread(target=edit, args=(100 + i,)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+
+    assert service.n_computed == n_computed + 1
+    assert len([r for r in results if r is not None]) == 1
+
+def test_errors():
+    layers = load_layers()
+    with pytest.raises(ValueError):
+        layer_stack(layers[:1])
+
+    class FailingService(PreviewService):
+        def compute(self, layers):
+            if len(layers) > 2:
+                time.sleep(0.05)
+                raise ValueError("Bad stack")
+            return PreviewService.compute(self, layers)
+
+    service = FailingService(debounce=0)
+    errors = []
+
+    def request():
+        try:
+            service.request(layers)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=request) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=2)
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(errors) == 3
+    # Nothing is left in flight, so the next request computes again
+    with pytest.raises(ValueError):
+        service.request(layers)
@@ -0,0 +1,59 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+from reduction_batch import parse_settings, scan_settings, find_peaks_array, check_runs
+
+HEADER = """# Experiment IPTS-21391 Run 30806
+# Type: Specular
+# [Direct Beam Runs]
+# DB_ID  P0  PN  x_pos  x_width  y_pos  y_width  bg_pos  bg_width  dpix  tth  number  File
+# 1  0  0  180.0  10.0  130.0  80.0  30.0  20.0  210  0.0  30792  /SNS/REF_M/REF_M_30792.nxs.h5
+# [Data Runs]
+# scale  P0  PN  x_pos  x_width  y_pos  y_width  bg_pos  bg_width  extract_fan  dpix  tth  number  DB_ID  File
+# 1.0  0  0  150.0  8.0  130.0  80.0  30.0  20.0  False  210  1.2  30806  1  /SNS/REF_M/REF_M_30806.nxs.h5
+# [Data]
+0.01  1.0  0.1  0.001
+"""
+
+
+def _detector(x_center, y_min, y_max):
+    x = np.arange(304)[:, None]
+    y = np.arange(256)[None, :]
+    counts = 1000 * np.exp(-0.5 * ((x - x_center) / 2.0)**2) * ((y >= y_min) & (y <= y_max)) + 1
+    return counts
+
+
+def _loader(run_number):
+    if run_number == 30792:
+        return _detector(180, 95, 165), 210
+    return _detector(150, 95, 165), 210
+
+
+def test_parse_settings():
+    settings = parse_settings(HEADER.splitlines(True))
+    assert settings['process_type'] == 'Specular'
+    assert len(settings['direct_beam_runs']) == 1
+    assert len(settings['data_runs']) == 1
+    assert settings['direct_beam_runs'][0]['number'] == 30792
+    assert settings['data_runs'][0]['extract_fan'] is False
+    assert settings['data_runs'][0]['x_pos'] == 150.0
+
+
+def test_find_peaks_array():
+    x_peak, y_peak = find_peaks_array(_detector(150, 95, 165), x_max=180)
+    assert x_peak[0] < 150 < x_peak[1]
+    assert x_peak[1] - x_peak[0] < 12
+    assert abs(y_peak[0] - 95) <= 1 and abs(y_peak[1] - 165) <= 1
+
+
+def test_check_runs(tmpdir):
+    for i in range(3):
+        tmpdir.join('REF_M_3080%d_autoreduce.dat' % i).write(HEADER)
+    tmpdir.join('notes.txt').write("Nothing here\n")
+    assert len(list(scan_settings([str(tmpdir)]))) == 3
+
+    checks = check_runs([str(tmpdir)], processes=1, loader=_loader)
+    assert len(checks) == 6
+    assert [c.status() for c in checks] == ['OK'] * 6
+    assert checks[0].direct_beam and not checks[1].direct_beam
@@ -0,0 +1,52 @@
+import subprocess
+import sys
+sys.path.append('../src')
+
+import pytest
+
+pytest.importorskip('refl1d')
+
+# Run load_bumps() in a fresh interpreter, where nothing else has imported
+# bumps.dream.state. The real state module is registered without being
+# attached to bumps.dream, and load_state() returns the best fit parameters.
+SCRIPT = """
+import importlib.util
+import sys
+sys.path.append('../src')
+import numpy as np
+
+spec = importlib.util.find_spec('bumps.dream.state')
+state_module = importlib.util.module_from_spec(spec)
+sys.modules['bumps.dream.state'] = state_module
+spec.loader.exec_module(state_module)
+
+class Draw(object):
+    def __init__(self, points):
+        self.points = points
+
+class State(object):
+    def __init__(self, points):
+        self.points = points
+
+    def mark_outliers(self):
+        pass
+
+    def draw(self, portion=1):
+        return Draw(self.points)
+
+from refl1d_model import ReflectivityProblem
+model = ReflectivityProblem('data/model152both')
+best = np.asarray([p[1] for p in model.fit_params])
+state_module.load_state = lambda file_path: State(np.asarray([best, best]))
+
+acc = model.load_bumps()
+print(sorted(acc.keys()))
+print(int(acc['T300'].counts.max()))
+"""
+
+
+def test_load_bumps_fresh_interpreter():
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT], universal_newlines=True)
+    lines = output.strip().splitlines()
+    assert lines[-2] == "['T050', 'T300']"
+    assert lines[-1] == '2'
@@ -0,0 +1,87 @@
+import sys
+sys.path.append('../src')
+
+import numpy as np
+import pytest
+from result_store import save_results, load_results
+
+class ProfileSet(object):
+    """ Minimal stand-in for an Accumulator that kept its draws """
+    def __init__(self, name, draws):
+        self.name = name
+        self.z = np.arange(len(draws[0]) + 1, dtype=float)
+        self.draws = np.asarray(draws)
+
+    def mean(self):
+        return self.draws.mean(axis=0), self.draws.std(axis=0)
+
+    def mean_magnetism(self):
+        return -self.draws.mean(axis=0), self.draws.std(axis=0)
+
+    def get_draws(self):
+        return self.draws, -self.draws
+
+def test_round_trip(tmpdir):
+    output = str(tmpdir.join('stats.npz'))
+    draws = np.random.RandomState(42).normal(size=(30, 12))
+    statistics = {'T300': ProfileSet('T300', draws)}
+    fit_params = [['intensity', 1.0991, 0.031], ['T300 MGN_1 rho', 0.906, 0.01]]
+
+    save_results(output, statistics, fit_params, keep_draws=True, chunk_size=8)
+
+    with load_results(output) as store:
+        assert store.model_names == ['T300']
+        assert store.fit_params[1][0] == 'T300 MGN_1 rho'
+        assert np.allclose([p[1] for p in store.fit_params], [1.0991, 0.906])
+
+        result = store['T300']
+        assert result.n_chunks == 4
+        assert np.allclose(result.draws(), draws)
+        assert np.allclose(result.draws(magnetic=True), -draws)
+        assert np.allclose(result.rho_mean, draws.mean(axis=0))
+        low, high = result.band(0.16, 0.84)
+        assert np.allclose(low, np.quantile(draws, 0.16, axis=0))
+        assert np.allclose(high, np.quantile(draws, 0.84, axis=0))
+
+
+class State(object):
+    """ Minimal stand-in for a bumps MCMC state """
+    def __init__(self, points):
+        self.points = points
+
+    def mark_outliers(self):
+        pass
+
+    def draw(self, portion=1):
+        return self
+
+
+def test_process(tmpdir, monkeypatch):
+    pytest.importorskip('refl1d')
+    from bumps.dream import state
+    from refl1d_model import ReflectivityProblem, process
+
+    filepath = 'data/model152both'
+    best = np.asarray([p[1] for p in ReflectivityProblem(filepath).fit_params])
+    points = best * (1 + 0.01 * np.random.RandomState(42).normal(size=(6, len(best))))
+    monkeypatch.setattr(state, 'load_state', lambda file_path: State(points))
+
+    output = str(tmpdir.join('model152both.npz'))
+    process(filepath, output, keep_draws=True)
+    statistics = ReflectivityProblem(filepath).load_bumps(keep_draws=True)
+
+    with load_results(output) as store:
+        assert sorted(store.model_names) == ['T050', 'T300']
+        assert len(store.fit_params) == 24
+        for name in store.model_names:
+            acc = statistics[name]
+            result = store[name]
+            rho_draws, rhoM_draws = acc.get_draws()
+            assert rho_draws.shape == (6, len(acc.z) - 1)
+            assert np.allclose(result.z, acc.z)
+            assert np.allclose(result.rho_mean, acc.mean()[0])
+            assert np.allclose(result.rhoM_sigma, acc.mean_magnetism()[1])
+            assert np.allclose(result.draws(), rho_draws)
+            low, high = result.band(0.16, 0.84, magnetic=True)
+            assert np.allclose(low, np.quantile(rhoM_draws, 0.16, axis=0))
+            assert np.allclose(high, np.quantile(rhoM_draws, 0.84, axis=0))
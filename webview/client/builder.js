@@ -1,9 +1,121 @@
+// Model and preview server (see src/preview_service.py). Another server
+// can be used with simple_builder.html?server=http://host:port
+const API_URL = new URLSearchParams(window.location.search).get('server') || 'http://localhost:3001';
+const PREVIEW_DELAY = 50;
+const CLIENT_ID = Math.random().toString(36).slice(2);
+const PARAMETER_TYPE = 'bumps.parameter.Parameter';
+const DEFAULT_LIMITS = ['-inf', 'inf'];
+
+function classOf(obj) {
+    return obj['__class__'] || obj['type'];
+}
+
+function compactParameter(par) {
+    // Same as compact_parameter() in src/model_json.py, without the ids
+    const output = {'__class__': 'Parameter', 'name': par['name']};
+    const slot = par['slot'] || {};
+    if (classOf(slot) === 'bumps.parameter.Calculation') {
+        output['calculation'] = slot['description'] || '';
+    } else if ([undefined, 'bumps.parameter.Variable'].includes(classOf(slot)) && 'value' in slot) {
+        // Inputs give strings
+        const value = Number(slot['value']);
+        output['value'] = (slot['value'] === '' || isNaN(value)) ? slot['value'] : value;
+    } else {
+        output['slot'] = slot;
+    }
+    output['fixed'] = ('fixed' in par) ? par['fixed'] : true;
+    if (par['limits'] && JSON.stringify(par['limits']) !== JSON.stringify(DEFAULT_LIMITS)) {
+        output['limits'] = par['limits'];
+    }
+    if (par['bounds'] !== undefined && par['bounds'] !== null) {
+        output['bounds'] = par['bounds'];
+    }
+    if (par['distribution'] && classOf(par['distribution']) !== 'bumps.parameter.Uniform') {
+        output['distribution'] = par['distribution'];
+    }
+    if (par['discrete']) {
+        output['discrete'] = true;
+    }
+    if (par['tags'] && par['tags'].length > 0) {
+        output['tags'] = par['tags'];
+    }
+    return output;
+}
+
+function compactModel(obj) {
+    if (Array.isArray(obj)) {
+        return obj.map(compactModel);
+    }
+    if (obj !== null && typeof obj === 'object') {
+        if (classOf(obj) === PARAMETER_TYPE) {
+            return compactParameter(obj);
+        }
+        const output = {};
+        for (const [key, value] of Object.entries(obj)) {
+            output[key] = compactModel(value);
+        }
+        return output;
+    }
+    return obj;
+}
+
+function escapeToken(token) {
+    return String(token).replace(/~/g, '~0').replace(/\//g, '~1');
+}
+
+function makePatch(oldValue, newValue, path) {
+    // Same as make_patch() in src/model_json.py
+    const isObject = (obj) => obj !== null && typeof obj === 'object' && !Array.isArray(obj);
+    if (isObject(oldValue) && isObject(newValue)) {
+        let patch = [];
+        for (const key of Object.keys(oldValue)) {
+            if (!(key in newValue)) {
+                patch.push({op: 'remove', path: path + '/' + escapeToken(key)});
+            }
+        }
+        for (const key of Object.keys(newValue)) {
+            const keyPath = path + '/' + escapeToken(key);
+            if (!(key in oldValue)) {
+                patch.push({op: 'add', path: keyPath, value: newValue[key]});
+            } else {
+                patch = patch.concat(makePatch(oldValue[key], newValue[key], keyPath));
+            }
+        }
+        return patch;
+    }
+    if (Array.isArray(oldValue) && Array.isArray(newValue) && oldValue.length === newValue.length) {
+        let patch = [];
+        oldValue.forEach((item, i) => {
+            patch = patch.concat(makePatch(item, newValue[i], path + '/' + i));
+        });
+        return patch;
+    }
+    if (JSON.stringify(oldValue) === JSON.stringify(newValue)) {
+        return [];
+    }
+    return [{op: 'replace', path: path, value: newValue}];
+}
+
 new Vue({
     el: '#app',
     data: {
         sortedLayers: [],
         dictionaryLoaded: false,
+        previewTimer: null,
+        previewRequest: null,
+        modelVersion: null,
+        modelPath: '',
+        syncedLayers: null,
+        modelSync: Promise.resolve(),
         },
+    watch: {
+        sortedLayers: {
+            handler() {
+                this.schedulePreview();
+            },
+            deep: true
+        }
+    },
     methods: {
         process() {
             // Sort. We should also reassign layer numbers so that it's nice and
@@ -13,17 +125,64 @@ new Vue({
         },
         async loadDictionary() {
             try {
-                const response = await fetch('http://localhost:3000/api/testdata');
+                // Edits are only sent back if the server accepts patches
+                this.modelVersion = null;
+                try {
+                    const model = await (await fetch(API_URL + '/api/model')).json();
+                    this.modelVersion = model['version'] || null;
+                } catch (error) {
+                    console.warn('Model edits will not be saved: ' + error);
+                }
+
+                const response = await fetch(API_URL + '/api/testdata');
                 const data = await response.json();
-                this.sortedLayers = data['models'][0]['sample']['layers'];
+                // Models serialized by bumps >= 1.0 are wrapped in an 'object'
+                const problem = data['object'] || data;
+                this.modelPath = (data['object'] ? '/object' : '') + '/models/0/sample/layers';
+                this.sortedLayers = problem['models'][0]['sample']['layers'];
                 for (const [index, item] of Object.entries(this.sortedLayers)) {
                     item['order'] = index;
                 }
+                this.syncedLayers = this.compactLayers();
                 this.dictionaryLoaded = true;
             } catch (error) {
                 console.error(error);
             }
         },
+        compactLayers() {
+            // Compact form of the layers, in the order given by the table
+            const layers = [...this.sortedLayers].sort((a, b) => a['order'] - b['order']);
+            return layers.map((layer) => {
+                const compact = compactModel(layer);
+                delete compact['order'];
+                return compact;
+            });
+        },
+        async syncModel() {
+            if (this.modelVersion === null) {
+                return;
+            }
+            const layers = this.compactLayers();
+            const patch = makePatch(this.syncedLayers, layers, this.modelPath);
+            if (patch.length === 0) {
+                return;
+            }
+            try {
+                const response = await fetch(API_URL + '/api/model', {
+                    method: 'PATCH',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({version: this.modelVersion, patch: patch})
+                });
+                const result = await response.json();
+                if (!response.ok) {
+                    throw new Error(result['error']);
+                }
+                this.modelVersion = result['version'];
+                this.syncedLayers = layers;
+            } catch (error) {
+                console.error('Could not save the model: ' + error);
+            }
+        },
         addLayer() {
             // TODO: Implement a better way to create a default layer so
             // that it's complete when we give it back to refl1d.
@@ -37,7 +196,8 @@ new Vue({
                     },
                     "fixed": true,
                     "limits": [0.0, "inf"],
-                    "bounds": null
+                    "bounds": null,
+                    "type": PARAMETER_TYPE
                 },
                 "interface": {
                     "name": "New Layer interface",
@@ -46,7 +206,8 @@ new Vue({
                         "value": 0
                     },
                     "limits": [0.0, "inf"],
-                    "bounds": [0.0, 100.0]
+                    "bounds": [0.0, 100.0],
+                    "type": PARAMETER_TYPE
                 },
                 "magnetism": null,
                 "material": {
@@ -58,7 +219,8 @@ new Vue({
                             "value": 0
                         },
                         "limits": ["-inf", "inf"],
-                        "bounds": null
+                        "bounds": null,
+                        "type": PARAMETER_TYPE
                     },
                     "irho": {
                         "name": "New Layer irho",
@@ -67,11 +229,50 @@ new Vue({
                             "value": 0
                         },
                         "limits": ["-inf", "inf"],
-                        "bounds": null
+                        "bounds": null,
+                        "type": PARAMETER_TYPE
                     }
                 }
             };
             this.sortedLayers.push(newLayer);
+        },
+        schedulePreview() {
+            // Wait for edits to settle so that a drag or a burst of
+            // keystrokes leads to a single request.
+            clearTimeout(this.previewTimer);
+            this.previewTimer = setTimeout(() => {
+                this.requestPreview();
+                // Patches are sent one at a time, each one based on the last
+                this.modelSync = this.modelSync.then(() => this.syncModel());
+            }, PREVIEW_DELAY);
+        },
+        async requestPreview() {
+            // Only the latest request matters
+            if (this.previewRequest) {
+                this.previewRequest.abort();
+            }
+            this.previewRequest = new AbortController();
+            try {
+                const response = await fetch(API_URL + '/api/preview', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({client: CLIENT_ID, layers: this.sortedLayers}),
+                    signal: this.previewRequest.signal
+                });
+                const preview = await response.json();
+                if (preview['superseded'] || preview['error']) {
+                    return;
+                }
+                Plotly.react('sld-preview', [{x: preview['z'], y: preview['rho'], name: 'SLD'}],
+                             {xaxis: {title: 'z'}, yaxis: {title: 'SLD'}, width: 500, height: 350});
+                Plotly.react('refl-preview', [{x: preview['q'], y: preview['r'], name: 'R'}],
+                             {xaxis: {title: 'Q', type: 'log'}, yaxis: {title: 'R', type: 'log'},
+                              width: 500, height: 350});
+            } catch (error) {
+                if (error.name !== 'AbortError') {
+                    console.error(error);
+                }
+            }
         }
     }
 });